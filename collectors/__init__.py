@@ -1,10 +1,6 @@
-from collectors.adjust import adjust_cmd
 from collectors.main import cli
-from collectors.redash import redash_cmd
 
-# Add subcommands here to get around weird inheritance issues
-cli.add_command(adjust_cmd)
-cli.add_command(redash_cmd)
+# Subcommands are registered lazily by collectors.main.SUBCOMMANDS
 
 
 # Workaroud to pass an empty context.obj
@@ -1,140 +1,596 @@
+import datetime as dt
 import logging
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import pandas as pd
 
-from collectors.common import load, connect, write_to_file
+from collectors.common import load, commit_loads, write_to_file, high_water_mark, stream_to_file, stream_format, \
+    ContentHash, concat_frames, data_filename, DEFAULT_CHUNKSIZE
+from collectors.fetch import open_url, NotModified
+from collectors.metrics import RunMetrics
 
 ADJUST_URL_BASE = "https://api.adjust.com/kpis/v1/{app_key}"
+HISTORY_START = "2000-01-01"
+HISTORY_END = "2030-01-01"
+DEFAULT_LOOKBACK_DAYS = 7
 logger = logging.getLogger(__name__)
 
 
-def collect(adj_settings, load_path, job) -> str:
+def collect(adj_settings, load_path, job, start_date=HISTORY_START, stream=False, fmt='csv',
+            content_hash=None, metrics=None, rollups=()) -> list:
     """
     Collect the data from adjust
     :param adj_settings: dictionary of settings specific to adjust.com
+    :param start_date: first day to request, defaults to the full history
+    :param stream: write the apps chunk by chunk to a single file instead of one file per app
+    :param fmt: format of the output files
+    :param content_hash: optional ContentHash of the collected data
+    :param metrics: optional RunMetrics recording the fetch and serialize stages
+    :param rollups: names of the job rollups to write next to the data, see write_apps
+    :return: paths to the output files
     """
     apps = adj_settings['apps']
     token = adj_settings['token']
+    workers = adj_settings.get('workers', 1)
+    chunksize = adj_settings.get('chunksize', DEFAULT_CHUNKSIZE)
+    metrics = metrics or RunMetrics('adjust')
 
-    df = merge_apps(apps, token, job)
-    return write_to_file(df, load_path)
+    if stream:
+        if rollups:
+            raise click.BadParameter("Rollups need whole apps, they can't be computed while streaming")
+        if job.PARTS:
+            raise click.BadParameter("Combined jobs need whole apps to be split, they can't be streamed")
+        # Fetching and writing are interleaved, the whole stream counts as fetching
+        with metrics.stage('fetch') as stage:
+            output_file = stream_to_file(stream_apps(apps, token, job, chunksize, start_date), load_path, fmt=fmt,
+                                         content_hash=content_hash)
+            stage['bytes'] = os.path.getsize(output_file)
+        return [output_file]
 
+    return write_apps(apps, token, job, load_path, workers, start_date, chunksize, fmt, content_hash, metrics,
+                      rollups)
 
-def merge_apps(apps, adjust_token, jobClass) -> pd.DataFrame:
+
+def app_filename(app) -> str:
+    """
+    Name of the output file of an app
+    """
+    return "output_{}.csv".format(re.sub(r'[^\w-]', '_', app))
+
+
+def rollup_files(data_files, rollup) -> list:
+    """
+    Paths to the files of a rollup, written by write_apps next to the data files
+    """
+    return [os.path.join(os.path.dirname(f), rollup, os.path.basename(f)) for f in data_files]
+
+
+def part_files(data_files, part) -> list:
     """
-    Call collect_app on each of the apps that we are tracking in adjust.com
+    Paths to the files of one of the parts of a combined job, written by write_apps to a directory named after it
+    """
+    return [f for f in data_files if os.path.basename(os.path.dirname(f)) == part.NAME]
+
+
+def write_apps(apps, adjust_token, jobClass, load_path, workers=1, start_date=HISTORY_START,
+               chunksize=DEFAULT_CHUNKSIZE, fmt='csv', content_hash=None, metrics=None, rollups=()) -> list:
+    """
+    Collect each of the apps that we are tracking in adjust.com concurrently and write every one of them to
+    its own file as soon as it arrives, the apps are never concatenated.
     :param apps: dict of app names and ids
     :param adjust_token: access token for adjust.com api
-    :return:
+    :param load_path: local path to write the data to
+    :param workers: maximum number of apps to fetch at the same time
+    :param start_date: first day to request
+    :param chunksize: number of rows parsed at a time
+    :param fmt: format of the output files
+    :param content_hash: optional ContentHash, fed with the apps in the order of `apps`.  The apps are hashed
+                         before they are written, the files of the apps that are unchanged since the last load (or
+                         that adjust.com answers are not modified) are kept as they are
+    :param metrics: optional RunMetrics recording the fetch and serialize stages, summed over the apps
+    :param rollups: names of the job rollups computed for each app, they are written to a sub-directory
+                    named after the rollup (see rollup_files)
+    :return: paths to the output files, in the order of `apps`.  The parts of a combined job are written to a
+             sub-directory named after each of them (see part_files)
+    """
+    metrics = metrics or RunMetrics('adjust')
+
+    def written_files(app):
+        # Files of an app written by a previous run, with those of its rollups
+        data_files = [os.path.join(load_path, part.NAME) if jobClass.PARTS else load_path
+                      for part in jobClass.PARTS or [jobClass]]
+        data_files = [os.path.join(path, data_filename(app_filename(app), fmt)) for path in data_files]
+        rollup_paths = [path for rollup in rollups for part, data_file in zip(jobClass.PARTS or [jobClass], data_files)
+                        if rollup in part.ROLLUPS for path in rollup_files([data_file], rollup)]
+        return data_files, rollup_paths
+
+    def collect_and_write(app, key):
+        data_files, rollup_paths = written_files(app)
+        written = all(os.path.exists(path) for path in data_files + rollup_paths)
+        loaded = content_hash.loaded_part(app) if content_hash is not None else None
+        try:
+            with metrics.stage('fetch') as stage:
+                df = collect_app(jobClass, app, key, adjust_token, start_date, chunksize, content_hash)
+                stage['rows'] = len(df)
+        except NotModified:
+            if written and loaded is not None:
+                # The files of the last load are still there, the app is neither parsed nor written again
+                return data_files, loaded
+            df = collect_app(jobClass, app, key, adjust_token, start_date, chunksize)
+
+        parts = jobClass().split(df, app)
+        digest = None
+        if content_hash is not None:
+            digest = content_hash.part_digest(b"".join(ContentHash.frame_digest(frame) for _, frame in parts))
+            if written and digest == loaded:
+                logger.info("{} is unchanged since the last load, keeping its files".format(app))
+                return data_files, digest
+
+        paths = []
+        for part, frame in parts:
+            part_path = os.path.join(load_path, part.NAME) if jobClass.PARTS else load_path
+            with metrics.stage('serialize') as stage:
+                paths.append(write_to_file(frame, part_path, filename=app_filename(app), fmt=fmt))
+                stage['bytes'] = os.path.getsize(paths[-1])
+            for rollup in rollups:
+                if rollup not in part.ROLLUPS:
+                    continue
+                with metrics.stage('rollup') as stage:
+                    aggregated = part().rollup(frame, rollup)
+                    if start_date != HISTORY_START:
+                        # Periods starting before the window were only partly fetched and are already loaded
+                        aggregated = aggregated[aggregated['adj_date'] >= pd.Timestamp(start_date)]
+                    stage['rows'] = len(aggregated)
+                    write_to_file(aggregated, os.path.join(part_path, rollup), filename=app_filename(app), fmt=fmt)
+        return paths, digest
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(collect_and_write, app, key) for app, key in apps.items()]
+        try:
+            results = [future.result() for future in futures]
+        except Exception:
+            # Don't start the remaining apps once one of them has failed
+            for future in futures:
+                future.cancel()
+            raise
+
+    if content_hash is not None:
+        for app, (_, digest) in zip(apps, results):
+            content_hash.add_part(app, digest)
+    return [path for paths, _ in results for path in paths]
+
+
+def collect_app(jobClass, app, key, adjust_token, start_date=HISTORY_START,
+                chunksize=DEFAULT_CHUNKSIZE, content_hash=None) -> pd.DataFrame:
+    """
+    Build the URL for a single app and collect its data
+    :param jobClass: job class used to build the url and parse the results
+    :param app: name of the app
+    :param key: adjust.com app key
+    :param adjust_token: access token for adjust.com api
+    :param start_date: first day to request
+    :param chunksize: number of rows parsed at a time
+    :param content_hash: optional ContentHash recording the version of the response, see fetch.open_url
+    :return: DataFrame of results for the app
+    """
+    job = jobClass()
+    url = job.build_url(key, adjust_token, start_date=start_date)
+    return job.collect(app, url, chunksize, content_hash)
+
+
+def stream_apps(apps, adjust_token, jobClass, chunksize=DEFAULT_CHUNKSIZE, start_date=HISTORY_START):
+    """
+    Stream the data of every app we are tracking in adjust.com, one chunk of rows at a time
+    :param apps: dict of app names and ids
+    :param adjust_token: access token for adjust.com api
+    :param chunksize: number of rows parsed and transformed at a time
+    :param start_date: first day to request
+    :return: generator of DataFrame chunks, in app order
     """
-    frames = []
     for app, key in apps.items():
         job = jobClass()
-        url = job.build_url(key, adjust_token)
-        df = job.collect(app, url)
-        frames.append(df)
+        url = job.build_url(key, adjust_token, start_date=start_date)
+        for chunk in job.stream(app, url, chunksize):
+            yield chunk
+        logging.info("{} collected".format(app))
 
-    df = pd.concat(frames)
 
-    return df
+def window_start(cursor, table, lookback_days) -> str:
+    """
+    Find the first day of the re-statement window for an incremental load
+    :param cursor: pyodbc cursor
+    :param table: name of the target table
+    :param lookback_days: number of days before the latest loaded adj_date that are fetched again
+    :return: ISO formatted start date, the start of history when the table is empty
+    """
+    latest = high_water_mark(cursor, table, 'adj_date')
+    if latest is None:
+        return HISTORY_START
 
+    if isinstance(latest, str):
+        latest = dt.datetime.strptime(latest[:10], "%Y-%m-%d").date()
+    return (latest - dt.timedelta(days=lookback_days)).isoformat()
+
+
+def rollup_start(start_date, freqs) -> str:
+    """
+    Move the start of an incremental window back to the start of the rollup periods it falls in, so that the
+    re-stated weeks or months are aggregated again in full.  The periods before the new start don't contain any
+    re-stated day and are left as they are.
+    :param start_date: ISO formatted start date
+    :param freqs: pandas frequencies of the rollups
+    :return: ISO formatted start date
+    """
+    start = pd.Timestamp(start_date)
+    return min([start] + [start.to_period(freq).start_time for freq in freqs]).date().isoformat()
 
-class DailyActiveUsers(object):
-    NAME = 'daily_active_users'
 
-    def build_url(self, app_key, token) -> str:
+class AdjustJob(object):
+    """
+    Base of the adjust.com jobs.  A job is declared by the endpoint it reads, the KPIs it requests, how they are
+    grouped and the typed schema of the CSV, which is parsed and transformed chunk by chunk.  Jobs reading the same
+    endpoint with the same grouping can be fetched together, see combine().
+    """
+    NAME = None
+    # Endpoint of the KPI service, one of ENDPOINTS
+    ENDPOINT = 'kpis'
+    KPIS = []
+    GROUPING = ['day', 'os_names']
+    OS_NAMES = ['android', 'ios']
+    # Columns the grouping produces, before the KPIs
+    DIMENSIONS = ['adj_date', 'os']
+    COLUMNS = []
+    # pandas dtypes of the columns, the date columns are parsed as dates
+    DTYPES = {}
+    DATE_COLUMNS = ['adj_date']
+    # Pre-aggregated tables the job can produce, by name, and the pandas frequency they aggregate the days to.  Jobs
+    # declaring rollups aggregate a frame to one of them with a rollup(df, name) method
+    ROLLUPS = {}
+    # Jobs fetched by a combined job
+    PARTS = []
+
+    def build_url(self, app_key, token, start_date=HISTORY_START, end_date=HISTORY_END) -> str:
         """
-        Build the adjust.com URL for daily activity
+        Build the adjust.com URL of the job for an app
         """
         url = ADJUST_URL_BASE.format(app_key=app_key)
-        url += ".csv"
+        url += ENDPOINTS[self.ENDPOINT]
         url += "?user_token={user_token}".format(user_token=token)
-        url += "&kpis=daus,waus,maus,installs"
-        url += "&start_date=2000-01-01"
-        url += "&end_date=2030-01-01"
-        url += "&grouping=day,os_names"
-        url += "&os_names=android,ios"
+        url += "&kpis={kpis}".format(kpis=",".join(self.KPIS))
+        url += "&start_date={start_date}".format(start_date=start_date)
+        url += "&end_date={end_date}".format(end_date=end_date)
+        url += "&grouping={grouping}".format(grouping=",".join(self.GROUPING))
+        url += "&os_names={os_names}".format(os_names=",".join(self.OS_NAMES))
         return url
 
-    def collect(self, app_name, url) -> pd.DataFrame:
+    def collect(self, app_name, url, chunksize=DEFAULT_CHUNKSIZE, content_hash=None) -> pd.DataFrame:
         """
-        Load the activity CSV for a given app
+        Load the CSV of a given app
         :param app_name: Name of the app that this data is for
         :param url: URL where the data can be retrieved
+        :param chunksize: number of rows parsed at a time
+        :param content_hash: optional ContentHash recording the version of the response, see fetch.open_url
         :return: DataFrame of results
         """
-        # Get the csv file from adjust and load it into pandas
-        col_names = ['adj_date', 'os', 'daus', 'waus', 'maus', 'installs']
-        df = pd.read_csv(url, sep=",", header=0, names=col_names)
+        df = concat_frames(self.stream(app_name, url, chunksize, content_hash))
+        logging.info("{} collected".format(app_name))
 
-        # Force convert missing to 0 for installs, this gets us through an unnecessary type conversion
-        df['installs'] = df['installs'].fillna(0).astype(int)
+        return df
 
-        # Append the app name
-        df['app'] = app_name
-        logging.info("{} collected".format(app_name))
+    def stream(self, app_name, url, chunksize=DEFAULT_CHUNKSIZE, content_hash=None):
+        """
+        Parse the CSV of a given app chunk by chunk
+        :param app_name: Name of the app that this data is for
+        :param url: URL where the data can be retrieved
+        :param chunksize: number of rows per chunk
+        :param content_hash: optional ContentHash recording the version of the response, see fetch.open_url
+        :return: generator of transformed DataFrame chunks
+        """
+        with open_url(url, source='adjust', content_hash=content_hash) as body:
+            reader = pd.read_csv(body, sep=",", header=0, names=self.COLUMNS, usecols=range(len(self.COLUMNS)),
+                                 dtype=self.DTYPES, parse_dates=self.DATE_COLUMNS, chunksize=chunksize)
+            for chunk in reader:
+                yield self.transform(chunk, app_name)
 
+    def transform(self, df, app_name) -> pd.DataFrame:
+        """
+        Append the app name to a frame (or chunk)
+        """
+        df['app'] = pd.Categorical([app_name] * len(df))
         return df
 
+    def split(self, df, app_name) -> list:
+        """
+        Frames of each job fetched by this one
+        :return: list of job classes and their frame
+        """
+        return [(type(self), df)]
 
-class Retention(object):
-    NAME = 'retention'
 
-    def build_url(self, app_key, token) -> str:
-        url = ADJUST_URL_BASE.format(app_key=app_key)
-        url += "/cohorts.csv"
-        url += "?user_token={user_token}".format(user_token=token)
-        url += "&kpis=retention_rate"
-        url += "&start_date=2000-01-01"
-        url += "&end_date=2030-01-01"
-        url += "&grouping=day,os_names"
-        url += "&os_names=android,ios"
-        return url
+class CombinedJob(AdjustJob):
+    """
+    Fetch the KPIs of several PARTS in one request per app and split the result
+    """
+
+    def transform(self, df, app_name) -> pd.DataFrame:
+        # The parts transform their own columns once split
+        return df
+
+    def split(self, df, app_name) -> list:
+        return [(part, part().transform(df[part.COLUMNS].copy(), app_name)) for part in self.PARTS]
+
+
+ENDPOINTS = {'kpis': ".csv", 'cohorts': "/cohorts.csv"}
+JOBS = {}
+
+
+def register(jobClass):
+    """
+    Make a job class available by its NAME, can be used as a class decorator
+    """
+    JOBS[jobClass.NAME] = jobClass
+    return jobClass
+
+
+@register
+class DailyActiveUsers(AdjustJob):
+    NAME = 'daily_active_users'
+    KPIS = ['daus', 'waus', 'maus', 'installs']
+    COLUMNS = ['adj_date', 'os', 'daus', 'waus', 'maus', 'installs']
+    DTYPES = {'os': 'category', 'daus': 'Int64', 'waus': 'Int64', 'maus': 'Int64', 'installs': 'Int64'}
 
-    def collect(self, app_name, url) -> pd.DataFrame:
+    def transform(self, df, app_name) -> pd.DataFrame:
         """
-        Load retention data for a given app
-        :param app_name: Name of the app
-        :param url: Constructed URL for requesting data from adjust.com
-        :return: DataFrame of results
+        Clean up a frame (or chunk) of activity data
         """
-        col_names = ['adj_date', 'os', 'period', 'retention_rate']
-        df = pd.read_csv(url, sep=",", header=0, names=col_names)
-        df['app'] = app_name
-        logging.info("{} collected".format(app_name))
-        return df
+        # Missing installs are loaded as 0
+        df['installs'] = df['installs'].fillna(0)
+        return super().transform(df, app_name)
 
 
-def select_job(ctx, param, value) -> object:
+@register
+class Retention(AdjustJob):
+    NAME = 'retention'
+    ENDPOINT = 'cohorts'
+    KPIS = ['retention_rate']
+    DIMENSIONS = ['adj_date', 'os', 'period']
+    COLUMNS = ['adj_date', 'os', 'period', 'retention_rate']
+    DTYPES = {'os': 'category', 'period': 'Int64', 'retention_rate': 'float64'}
+    ROLLUPS = {'weekly': 'W', 'monthly': 'M'}
+
+    def rollup(self, df, name) -> pd.DataFrame:
+        """
+        Average the retention curves of the daily cohorts of each week or month.  adj_date becomes the first day
+        of the week (Monday) or month and cohorts counts the daily cohorts averaged.
+        """
+        cohort_start = df['adj_date'].dt.to_period(self.ROLLUPS[name]).dt.start_time.rename('adj_date')
+        grouped = df.groupby([cohort_start, 'os', 'app', 'period'], observed=True, sort=True)['retention_rate']
+        rolled = grouped.agg(['mean', 'count']).reset_index()
+        return rolled.rename(columns={'mean': 'retention_rate', 'count': 'cohorts'})
+
+
+def declare_job(name, settings) -> type:
     """
-    Select the appropriate job
+    Build a job class from its declaration in the configuration:
+
+        kpis: {sessions: Int64, installs: Int64}     # KPIs and their pandas dtype, in the order of the CSV
+        endpoint: kpis                               # optional, kpis or cohorts
+        grouping: [day, os_names]                    # optional
+        os_names: [android, ios]                     # optional
+        dimensions: {adj_date: date, os: category}   # optional, columns of the grouping and their dtype
+
+    :param name: name of the job
+    :param settings: declaration of the job
+    :return: job class
     """
-    JOBS = dict(retention=Retention, daily_active_users=DailyActiveUsers)
+    settings = dict(settings)
     try:
-        return JOBS[value]
-    except:
-        raise click.BadParameter("Job must be one of {}".format(JOBS.keys()))
+        kpis = settings.pop('kpis')
+    except KeyError:
+        raise click.BadParameter("Job {} must declare its kpis".format(name))
+    endpoint = settings.pop('endpoint', AdjustJob.ENDPOINT)
+    if endpoint not in ENDPOINTS:
+        raise click.BadParameter("Endpoint of job {} must be one of {}".format(name, list(ENDPOINTS)))
+    dimensions = settings.pop('dimensions', {'adj_date': 'date', 'os': 'category'})
+    attributes = {
+        'NAME': name,
+        'ENDPOINT': endpoint,
+        'GROUPING': list(settings.pop('grouping', AdjustJob.GROUPING)),
+        'OS_NAMES': list(settings.pop('os_names', AdjustJob.OS_NAMES)),
+        'KPIS': list(kpis),
+        'DIMENSIONS': list(dimensions),
+        'COLUMNS': list(dimensions) + list(kpis),
+        'DTYPES': {c: t for c, t in list(dimensions.items()) + list(kpis.items()) if t != 'date'},
+        'DATE_COLUMNS': [c for c, t in dimensions.items() if t == 'date'],
+    }
+    if settings:
+        raise click.BadParameter("Job {} has unknown settings {}".format(name, sorted(settings)))
+    return type(str(name), (AdjustJob,), attributes)
 
 
-@click.command('adjust')
-@click.option("--table", type=str, required=True, help="Name of the target table where the load should be persisted")
-@click.option("--job", callback=select_job, required=True)
-@click.pass_context
-def adjust_cmd(ctx, table, job) -> None:
-    # Grab a vertica connection
-    cursor = connect(ctx.obj['config']['vertica']['dsn'])
+def get_job(name, adj_settings=None) -> object:
+    """
+    Look up a job class by name, among the jobs declared in the adjust settings then the registered ones
+    """
+    declared = (adj_settings or {}).get('jobs') or {}
+    if name in declared:
+        return declare_job(name, declared[name])
+    try:
+        return JOBS[name]
+    except KeyError:
+        raise click.BadParameter("Job must be one of {}".format(sorted(set(JOBS) | set(declared))))
+
+
+def select_job(ctx, param, value) -> tuple:
+    """
+    Select the appropriate jobs
+    """
+    adj_settings = (ctx.obj or {}).get('config', {}).get('adjust')
+    return tuple(get_job(name, adj_settings) for name in value)
+
+
+def combine(jobs) -> type:
+    """
+    Combine jobs reading the same endpoint with the same grouping into one, fetching all their KPIs in a single
+    request per app
+    :param jobs: job classes
+    :return: the job itself when there is only one, a CombinedJob of them otherwise
+    """
+    if len(jobs) == 1:
+        return jobs[0]
+
+    def request(job):
+        return job.ENDPOINT, job.GROUPING, job.OS_NAMES, job.DIMENSIONS
+
+    if any(request(job) != request(jobs[0]) for job in jobs):
+        raise click.BadParameter("Only jobs with the same endpoint, grouping and dimensions can be combined, "
+                                 "{} can't".format([job.NAME for job in jobs]))
+    kpis, dtypes = [], {}
+    for job in jobs:
+        kpis += [kpi for kpi in job.KPIS if kpi not in kpis]
+        dtypes.update(job.DTYPES)
+    first = jobs[0]
+    attributes = {
+        'NAME': "_".join(job.NAME for job in jobs),
+        'ENDPOINT': first.ENDPOINT,
+        'GROUPING': first.GROUPING,
+        'OS_NAMES': first.OS_NAMES,
+        'KPIS': kpis,
+        'DIMENSIONS': first.DIMENSIONS,
+        'COLUMNS': first.DIMENSIONS + kpis,
+        'DTYPES': dtypes,
+        'DATE_COLUMNS': first.DATE_COLUMNS,
+        'PARTS': list(jobs),
+    }
+    return type('CombinedJob', (CombinedJob,), attributes)
+
+
+def run(config, pool, table, job, incremental=False, lookback_days=None, stream=False, load_path=None,
+        force=False, rollups=()) -> dict:
+    """
+    Collect adjust.com jobs and load them into vertica.  Several jobs are fetched together in one request per app
+    and split into their own table.
+    :param config: base configuration of the collectors
+    :param pool: ConnectionPool used to reach vertica
+    :param table: name of the target table, or a list of them matching the jobs
+    :param job: job class or the name of one, or a list of them to combine (see combine)
+    :param load_path: local path to write the data to, defaults to a directory named after the job
+    :param force: load the data even if it is the same as the last load
+    :param rollups: names of job rollups to load next to the data, each into the table {table}_{rollup}
+    :return: summary of the run: rows, bytes and seconds spent fetching and loading, skipped when the data
+             was unchanged
+    """
+    adj_settings = config['adjust']
+    tables = [table] if isinstance(table, str) else list(table)
+    jobs = list(job) if isinstance(job, (list, tuple)) else [job]
+    jobs = [get_job(j, adj_settings) if isinstance(j, str) else j for j in jobs]
+    if len(tables) != len(jobs):
+        raise click.BadParameter("Each of the jobs {} needs its own table, got {}".format(
+            [j.NAME for j in jobs], tables))
+    job = combine(jobs)
+    table = ",".join(tables)
+    rollups = list(rollups or ())
+    unknown = [r for r in rollups if not any(r in j.ROLLUPS for j in jobs)]
+    if unknown:
+        raise click.BadParameter("{} has no rollup {}, it has {}".format(
+            job.NAME, unknown, sorted(set(r for j in jobs for r in j.ROLLUPS))))
 
     # Setup the load_path
-    load_path = os.path.join(ctx.obj['config']['data_dir'], job.NAME)
+    if load_path is None:
+        load_path = os.path.join(config['data_dir'], job.NAME)
+
+    fmt = config.get('data_format', 'csv')
+    if stream:
+        fmt = stream_format(fmt)
+
+    with RunMetrics('adjust', table) as run_metrics:
+        started = time.time()
+
+        # Work out which days need to be (re)loaded, from the table that is the furthest behind
+        start_date, where = HISTORY_START, None
+        if incremental:
+            if lookback_days is None:
+                lookback_days = adj_settings.get('lookback_days', DEFAULT_LOOKBACK_DAYS)
+            with pool.cursor() as cursor:
+                start_date = min(window_start(cursor, t, lookback_days) for t in tables)
+            if rollups:
+                start_date = rollup_start(start_date, [j.ROLLUPS[r] for j in jobs for r in rollups if r in j.ROLLUPS])
+            if start_date != HISTORY_START:
+                where = "adj_date >= '{start_date}'".format(start_date=start_date)
+            logger.info("Incremental load of {table} starting at {start_date}".format(
+                table=table, start_date=start_date))
+
+        # Collect the data from adjust.com
+        salt = ",".join([start_date] + rollups)
+        content_hash = ContentHash(load_path, table, salt=salt, force=force)
+        output_files = collect(adj_settings, load_path, job, start_date, stream, fmt, content_hash, run_metrics,
+                               rollups)
+        fetched = time.time()
 
-    # Collect the data from adjust.com
-    output_file = collect(ctx.obj['config']['adjust'], load_path, job)
+        if content_hash.unchanged():
+            logger.info("{table} is unchanged since the last load, skipping it".format(table=table))
+            run_metrics.status = 'unchanged'
+            return {'rows': 0, 'bytes': None, 'fetch_secs': fetched - started, 'load_secs': 0, 'skipped': True}
 
-    reject_file = os.path.join(load_path, "rejects")
-    exception_file = os.path.join(load_path, "exceptions")
-    load(cursor, table, output_file, reject_file, exception_file)
+        reject_file = os.path.join(load_path, "rejects")
+        exception_file = os.path.join(load_path, "exceptions")
+        swap = config['vertica'].get('swap', False)
+        # The table of each job, then the tables of its rollups
+        loads = []
+        for part, part_table in zip(jobs, tables):
+            data_files = part_files(output_files, part) if job.PARTS else output_files
+            loads.append((part_table, data_files, False))
+            loads += [("{table}_{rollup}".format(table=part_table, rollup=rollup), rollup_files(data_files, rollup),
+                       True) for rollup in rollups if rollup in part.ROLLUPS]
+
+        # Several tables are committed (or swapped in) together, a failure loading any of them leaves all of them
+        # as they were
+        together = len(loads) > 1
+        with run_metrics.stage('load') as stage, pool.cursor() as cursor:
+            stage['rows'], stage['bytes'] = 0, 0
+            for load_table, data_files, is_rollup in loads:
+                rows = load(cursor, load_table, data_files, reject_file, exception_file, where=where, swap=swap,
+                            fmt=fmt, commit=not together)
+                if is_rollup:
+                    logger.info("Loaded {rows} rows into {table}".format(rows=rows, table=load_table))
+                else:
+                    stage['rows'] += rows
+                stage['bytes'] += sum(os.path.getsize(f) for f in data_files)
+            if together:
+                commit_loads(cursor, [load_table for load_table, _, _ in loads], swap)
+        content_hash.save()
+
+        return {
+            'rows': stage['rows'],
+            'bytes': stage['bytes'],
+            'fetch_secs': fetched - started,
+            'load_secs': time.time() - fetched,
+        }
+
+
+@click.command('adjust')
+@click.option("--table", "tables", type=str, required=True, multiple=True,
+              help="Name of the target table where the load should be persisted, one per job")
+@click.option("--job", "jobs", callback=select_job, required=True, multiple=True,
+              help="Job to collect, a registered one or one declared in the adjust settings.  Jobs given together "
+                   "are fetched in one request per app")
+@click.option("--incremental", is_flag=True, default=False,
+              help="Only fetch and replace the trailing window of days after the latest loaded adj_date")
+@click.option("--lookback-days", type=int, default=None,
+              help="Size of the re-statement window used by --incremental")
+@click.option("--stream", is_flag=True, default=False,
+              help="Parse and write the apps chunk by chunk to keep memory flat")
+@click.option("--force", is_flag=True, default=False, help="Load the data even if it didn't change since the last load")
+@click.option("--rollup", "rollups", multiple=True,
+              help="Also load a pre-aggregated rollup of the job into {table}_{rollup}, e.g. weekly or monthly")
+@click.pass_context
+def adjust_cmd(ctx, tables, jobs, incremental, lookback_days, stream, force, rollups) -> None:
+    run(ctx.obj['config'], ctx.obj['pool'], tables, jobs, incremental, lookback_days, stream, force=force,
+        rollups=rollups)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+"""
+Run many collector jobs from a manifest inside a single process, sharing configuration and vertica connections
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from collectors import adjust, redash, s3_fetcher
+from collectors.main import load_yaml
+
+DEFAULT_PARALLELISM = 4
+RUNNERS = dict(adjust=adjust.run, redash=redash.run, s3=s3_fetcher.run)
+
+logger = logging.getLogger(__name__)
+
+
+def table_name(spec) -> str:
+    """
+    Target table of a job of the manifest, the tables of combined adjust jobs are joined by commas
+    """
+    table = spec.get('table')
+    return ",".join(table) if isinstance(table, (list, tuple)) else table
+
+
+def job_name(spec) -> str:
+    """
+    Name a job of the manifest, either explicitly or after its type and target table
+    """
+    return str(spec.get('name', "{}-{}".format(spec.get('type'), table_name(spec))))
+
+
+def validate(jobs) -> None:
+    """
+    Check a manifest before anything runs
+    :param jobs: list of job specifications
+    """
+    names = set()
+    for spec in jobs:
+        if spec.get('type') not in RUNNERS:
+            raise click.BadParameter("Job type must be one of {}, got {}".format(list(RUNNERS), spec.get('type')))
+        if 'table' not in spec:
+            raise click.BadParameter("Job {} has no target table".format(job_name(spec)))
+
+        name = job_name(spec)
+        if name in names:
+            raise click.BadParameter("Job name {} is used more than once".format(name))
+        names.add(name)
+
+
+def run_job(config, pool, spec) -> dict:
+    """
+    Run a single job of the manifest, failures are reported in the summary instead of being raised
+    :param config: base configuration of the collectors
+    :param pool: ConnectionPool shared by all the jobs
+    :param spec: job specification from the manifest
+    :return: summary of the job
+    """
+    name = job_name(spec)
+    kwargs = {k: v for k, v in spec.items() if k not in ('type', 'name')}
+    kwargs.setdefault('load_path', os.path.join(config['data_dir'], 'batch', name))
+
+    summary = dict(name=name, type=spec['type'], table=table_name(spec), status='ok', rows=None, bytes=None,
+                   fetch_secs=None, load_secs=None, error=None)
+    started = time.time()
+    try:
+        result = RUNNERS[spec['type']](config, pool, **kwargs)
+        if result.pop('skipped', False):
+            summary['status'] = 'unchanged'
+        summary.update(result)
+    except Exception as e:
+        logger.exception("Job {} failed".format(name))
+        summary.update(status='failed', error=str(e))
+    summary['total_secs'] = time.time() - started
+    return summary
+
+
+def run_batch(config, pool, jobs, parallelism=DEFAULT_PARALLELISM) -> list:
+    """
+    Run the jobs of a manifest concurrently
+    :param config: base configuration of the collectors
+    :param pool: ConnectionPool shared by all the jobs
+    :param jobs: list of job specifications
+    :param parallelism: maximum number of jobs running at the same time
+    :return: list of job summaries, in manifest order
+    """
+    validate(jobs)
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        return list(executor.map(lambda spec: run_job(config, pool, spec), jobs))
+
+
+def format_summary(summaries) -> str:
+    """
+    Render job summaries as a plain text table
+    """
+    def fmt(value, pattern="{}"):
+        return "-" if value is None else pattern.format(value)
+
+    header = "{:<30} {:<7} {:<9} {:>10} {:>12} {:>9} {:>9} {:>9}".format(
+        "job", "type", "status", "rows", "bytes", "fetch(s)", "load(s)", "total(s)")
+    lines = [header]
+    for s in summaries:
+        lines.append("{:<30} {:<7} {:<9} {:>10} {:>12} {:>9} {:>9} {:>9}".format(
+            s['name'], s['type'], s['status'], fmt(s['rows']), fmt(s['bytes']), fmt(s['fetch_secs'], "{:.1f}"),
+            fmt(s['load_secs'], "{:.1f}"), fmt(s['total_secs'], "{:.1f}")))
+        if s['error']:
+            lines.append("    {}".format(s['error']))
+    return "\n".join(lines)
+
+
+@click.command('run-batch')
+@click.argument("manifest", callback=load_yaml, type=click.Path(exists=True, readable=True))
+@click.option("--parallelism", type=int, default=None, help="Maximum number of jobs running at the same time")
+@click.pass_context
+def batch_cmd(ctx, manifest, parallelism) -> None:
+    """
+    Run every job listed in a YAML manifest
+    """
+    config = ctx.obj['config']
+    if parallelism is None:
+        parallelism = manifest.get('parallelism', config.get('batch', {}).get('parallelism', DEFAULT_PARALLELISM))
+
+    summaries = run_batch(config, ctx.obj['pool'], manifest['jobs'], parallelism)
+    click.echo(format_summary(summaries))
+
+    failed = [s['name'] for s in summaries if s['status'] == 'failed']
+    if failed:
+        logger.error("{} of {} jobs failed: {}".format(len(failed), len(summaries), ", ".join(failed)))
+        ctx.exit(1)
+
+
+if __name__ == '__main__':
+    batch_cmd()
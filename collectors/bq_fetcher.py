@@ -21,11 +21,46 @@ For more information, see the README.rst.
 """
 
 import argparse
+import functools
 import json
+import threading
 import time
 import uuid
 
-import googleapiclient.discovery
+MAX_POLL_INTERVAL = 30
+
+_local = threading.local()
+
+
+def get_service(name='bigquery', version='v2'):
+    """
+    Builds a google-api-client service object once per thread, later calls
+    from the same thread reuse it instead of fetching the discovery document
+    again.  A service object and its httplib2 transport are not thread-safe,
+    threads never share one.
+    """
+    import googleapiclient.discovery
+
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    if (name, version) not in services:
+        # [START build_service]
+        # Construct the service object for interacting with the BigQuery API.
+        services[(name, version)] = googleapiclient.discovery.build(
+            name, version)
+        # [END build_service]
+    return services[(name, version)]
+
+
+@functools.lru_cache(maxsize=None)
+def load_schema(schema_file):
+    """
+    Reads and parses a JSON schema file once per process.  The parsed
+    schema is shared between callers and must not be modified.
+    """
+    with open(schema_file, 'r') as f:
+        return json.load(f)
 
 
 def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
@@ -38,10 +73,13 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
         source_schema: a valid bigquery schema,
         see https://cloud.google.com/bigquery/docs/reference/v2/tables
         source_path: the fully qualified Google Cloud Storage location of
-        the data to load into your table
+        the data to load into your table, or a list of them.  Locations can
+        use a * wildcard, e.g. gs://bucket/export/2018-01-*.csv
     Returns: a bigquery load job, see
     https://cloud.google.com/bigquery/docs/reference/v2/jobs#configuration.load
     """
+    source_uris = [source_path] if isinstance(source_path, str) \
+        else list(source_path)
 
     # Generate a unique job ID so retries
     # don't accidentally duplicate query
@@ -52,7 +90,7 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
         },
         'configuration': {
             'load': {
-                'sourceUris': [source_path],
+                'sourceUris': source_uris,
                 'schema': {
                     'fields': source_schema
                 },
@@ -69,46 +107,108 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
         projectId=project_id,
         body=job_data).execute(num_retries=num_retries)
 
-def poll_job(bigquery, job):
-    """Waits for a job to complete."""
 
-    print('Waiting for job to finish...')
+def submit_jobs(bigquery, project_id, dataset_id, loads, num_retries=5):
+    """
+    Starts one load job per table without waiting for any of them
+    Args:
+        bigquery: an initialized and authorized bigquery client
+        google-api-client object
+        loads: list of (table_name, source_schema, source_path) tuples
+    Returns: list of the submitted bigquery load jobs
+    """
+    jobs = []
+    for table_name, source_schema, source_path in loads:
+        job = load_table(bigquery, project_id, dataset_id, table_name,
+                         source_schema, source_path, num_retries)
+        job['submittedAt'] = time.time()
+        jobs.append(job)
+    return jobs
 
-    request = bigquery.jobs().get(
-        projectId=job['jobReference']['projectId'],
-        jobId=job['jobReference']['jobId'])
 
+def poll_jobs(bigquery, jobs, poll_interval=1,
+              max_interval=MAX_POLL_INTERVAL, num_retries=2):
+    """
+    Waits for several jobs to complete, polling all of the unfinished ones
+    in each round.  The wait between rounds starts at poll_interval and
+    doubles up to max_interval.
+    Args:
+        bigquery: an initialized and authorized bigquery client
+        google-api-client object
+        jobs: bigquery jobs as returned by load_table or submit_jobs
+    Returns: one summary per job, in the same order, with its table, final
+    state, error if any and elapsed seconds
+    Raises: RuntimeError once every job is done if any of them failed
+    """
+    summaries = [{
+        'jobId': job['jobReference']['jobId'],
+        'table': job.get('configuration', {}).get('load', {}).get(
+            'destinationTable', {}).get('tableId'),
+        'state': None,
+        'error': None,
+        'elapsed_secs': None,
+    } for job in jobs]
+    pending = list(range(len(jobs)))
+    interval = poll_interval
+
+    print('Waiting for {} jobs to finish...'.format(len(jobs)))
     while True:
-        result = request.execute(num_retries=2)
+        for i in list(pending):
+            reference = jobs[i]['jobReference']
+            result = bigquery.jobs().get(
+                projectId=reference['projectId'],
+                jobId=reference['jobId']).execute(num_retries=num_retries)
+            summaries[i]['state'] = result['status']['state']
+            if result['status']['state'] == 'DONE':
+                summaries[i]['error'] = result['status'].get('errorResult')
+                summaries[i]['elapsed_secs'] = (
+                    time.time() - jobs[i].get('submittedAt', time.time()))
+                pending.remove(i)
+                print('Job {jobId} for {table} complete in '
+                      '{elapsed_secs:.1f}s.'.format(**summaries[i]))
+
+        if not pending:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+    errors = [s['error'] for s in summaries if s['error']]
+    if errors:
+        raise RuntimeError(errors)
+    return summaries
+
+
+def poll_job(bigquery, job, poll_interval=1):
+    """Waits for a job to complete."""
+    return poll_jobs(bigquery, [job], poll_interval)[0]
 
-        if result['status']['state'] == 'DONE':
-            if 'errorResult' in result['status']:
-                raise RuntimeError(result['status']['errorResult'])
-            print('Job complete.')
-            return
 
-        time.sleep(1)
+def load_tables(bigquery, project_id, dataset_id, loads, poll_interval=1,
+                num_retries=5):
+    """
+    Loads several tables at once, taking about as long as the slowest one
+    Args:
+        loads: list of (table_name, source_schema, source_path) tuples, the
+        source_path being one or more Google Cloud Storage locations
+    Returns: one summary per load, see poll_jobs
+    """
+    jobs = submit_jobs(bigquery, project_id, dataset_id, loads, num_retries)
+    return poll_jobs(bigquery, jobs, poll_interval, num_retries=num_retries)
+
 
 def main(project_id, dataset_id, table_name, schema_file, data_path,
          poll_interval, num_retries):
-    # [START build_service]
-    # Construct the service object for interacting with the BigQuery API.
-    bigquery = googleapiclient.discovery.build('bigquery', 'v2')
-    # [END build_service]
-
-    with open(schema_file, 'r') as f:
-        schema = json.load(f)
+    bigquery = get_service()
+    schema = load_schema(schema_file)
 
-    job = load_table(
+    load_tables(
         bigquery,
         project_id,
         dataset_id,
-        table_name,
-        schema,
-        data_path,
+        [(table_name, schema, data_path)],
+        poll_interval,
         num_retries)
 
-    poll_job(bigquery, job)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -122,9 +222,9 @@ if __name__ == '__main__':
         'schema_file',
         help='Path to a schema file describing the table schema.')
     parser.add_argument(
-        'data_path',
-        help='Google Cloud Storage path to the CSV data, for example: '
-             'gs://mybucket/in.csv')
+        'data_path', nargs='+',
+        help='Google Cloud Storage paths to the CSV data, loaded in a single '
+             'job, for example: gs://mybucket/in.csv gs://mybucket/2018-*.csv')
     parser.add_argument(
         '-p', '--poll_interval',
         help='How often to poll the query for completion (seconds).',
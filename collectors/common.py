@@ -1,73 +1,572 @@
+import contextlib
+import gzip
+import hashlib
+import itertools
+import json
 import logging
 import os
-import pyodbc
+import queue
 
 logger = logging.getLogger(__name__)
 
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Number of CSV rows parsed at a time
+DEFAULT_CHUNKSIZE = 100000
 
-def load(cursor, table, data_file, reject_file, exception_file) -> None:
+# Intermediate file formats: file extension, COPY parser clause and whether the file can be sent with COPY LOCAL.
+# vertica can't COPY LOCAL columnar files, those are read by the nodes so data_dir has to be shared with them.
+FORMATS = {
+    'csv': dict(extension='.csv', parser="DELIMITER ',' SKIP {skip}", local=True),
+    'csv.gz': dict(extension='.csv.gz', parser="GZIP DELIMITER ',' SKIP {skip}", local=True),
+    'parquet': dict(extension='.parquet', parser="PARQUET", local=False),
+    'orc': dict(extension='.orc', parser="ORC", local=False),
+}
+STREAM_FORMATS = ('csv', 'csv.gz')
+
+
+def load(cursor, table, data_file, reject_file, exception_file, where=None, swap=False, skip=1,
+         before_commit=None, fmt='csv', commit=True) -> int:
     """
     Truncate a vertica table and then execute a load.  This assumes that the source and target schemas
     implicitly match
     :param cursor: pyodbc cursor
     :param table: name of the table to load
-    :param data_file: path to load from
+    :param data_file: path to load from, or list of paths loaded by a single COPY
     :param reject_file: path to store rejected data
     :param exception_file: path to store encountered exceptions
-    :return:
-    """
-    # Truncate the table before the load since every load is a FULL rewrite
-    trunc_tmpl = "TRUNCATE TABLE {tbl}"
-    cursor.execute(trunc_tmpl.format(tbl=table))
-
-    files = {
-        "data_file": data_file,
-        "reject_file": reject_file,
-        "exception_file": exception_file
-    }
-
-    # Copy the local file
-    copy_tmpl = "COPY {table} FROM LOCAL '{data_file}' " \
-                "DELIMITER ',' SKIP 1 " \
-                "REJECTED DATA '{reject_file}' " \
-                "EXCEPTIONS '{exception_file}' " \
-                "ABORT ON ERROR DIRECT"
-    copy_stmt = copy_tmpl.format(table=table, **files)
-    print(copy_stmt)
-    cursor.execute(copy_stmt)
+    :param where: optional predicate, only the rows matching it are replaced instead of the whole table
+    :param swap: load a staging copy of the table and swap it in atomically, readers never see a partial table
+    :param skip: number of header lines to skip
+    :param before_commit: optional callable run once the COPY is done, raising from it prevents the commit and
+                          rolls the whole load back, the table is then emptied with DELETE rather than TRUNCATE
+    :param fmt: format of the data file, one of FORMATS
+    :param commit: commit the load (or swap its staging table in), otherwise it is left pending and committed
+                   together with the loads of other tables by commit_loads, the table is then emptied with DELETE
+    :return: number of rows loaded
+    """
+    target = table
+    if swap:
+        target = prepare_staging(cursor, table, where)
+    elif where is None and before_commit is None and commit:
+        # Truncate the table before the load since every load is a FULL rewrite
+        trunc_tmpl = "TRUNCATE TABLE {tbl}"
+        cursor.execute(trunc_tmpl.format(tbl=table))
+    elif where is None:
+        # TRUNCATE commits on its own, the rows are deleted in the transaction before_commit may roll back or
+        # that commit_loads commits
+        cursor.execute("DELETE FROM {tbl}".format(tbl=table))
+    else:
+        # Only the re-stated window is rewritten, it is committed together with the load
+        delete_tmpl = "DELETE FROM {tbl} WHERE {where}"
+        cursor.execute(delete_tmpl.format(tbl=table, where=where))
+
+    cursor.execute(copy_statement(target, data_file, reject_file, exception_file, skip, fmt))
+    count = cursor.rowcount
     logger.info("Completed loading {table} - #{count} Records".format(
         table=table,
-        count=cursor.rowcount
+        count=count
     ))
 
-    commit_sql = "INSERT INTO last_updated (name, updated_at, updated_by) " \
-                 "VALUES ('{table}', now(), 'Data-Collectors');".format(table=table)
-    cursor.execute(commit_sql)
-    cursor.execute("COMMIT;")
+    if before_commit is not None:
+        before_commit()
+
+    if commit:
+        commit_loads(cursor, [table], swap)
+    return count
+
+
+def commit_loads(cursor, tables, swap=False) -> None:
+    """
+    Record the loads of tables in last_updated and commit them together, a failure before leaves every table as
+    it was once the transaction is rolled back
+    :param cursor: pyodbc cursor
+    :param tables: names of the tables loaded by load(commit=False)
+    :param swap: whether the tables were loaded with swap, their staging tables are then swapped in
+    """
+    for table in tables:
+        commit_sql = "INSERT INTO last_updated (name, updated_at, updated_by) " \
+                     "VALUES ('{table}', now(), 'Data-Collectors');".format(table=table)
+        cursor.execute(commit_sql)
+
+    if swap:
+        # The rename commits the transaction, last_updated becomes visible together with the new data
+        swap_tables(cursor, tables)
+    else:
+        cursor.execute("COMMIT;")
+
+
+def copy_statement(table, data_file, reject_file, exception_file, skip=1, fmt='csv') -> str:
+    """
+    Build the COPY statement loading one or several data files
+    :param table: name of the table to load
+    :param data_file: path to load from, or list of paths that vertica parses in parallel
+    :param reject_file: path to store rejected data
+    :param exception_file: path to store encountered exceptions
+    :param skip: number of header lines to skip (in each file), for text formats
+    :param fmt: format of the data files, one of FORMATS
+    :return: COPY statement
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Format must be one of {}, got {}".format(list(FORMATS), fmt))
+    spec = FORMATS[fmt]
+    data_files = [data_file] if isinstance(data_file, str) else list(data_file)
+
+    if spec['local']:
+        # Copy the local files
+        copy_tmpl = "COPY {table} FROM LOCAL {sources} " \
+                    "{parser} " \
+                    "REJECTED DATA '{reject_file}' " \
+                    "EXCEPTIONS '{exception_file}' " \
+                    "ABORT ON ERROR DIRECT"
+        sources = ", ".join("'{}'".format(f) for f in data_files)
+    else:
+        # Columnar files are read by the vertica nodes
+        copy_tmpl = "COPY {table} FROM {sources} " \
+                    "{parser} " \
+                    "ABORT ON ERROR DIRECT"
+        sources = ", ".join("'{}' ON ANY NODE".format(f) for f in data_files)
+
+    copy_stmt = copy_tmpl.format(
+        table=table,
+        sources=sources,
+        parser=spec['parser'].format(skip=skip),
+        reject_file=reject_file,
+        exception_file=exception_file
+    )
+    logger.info(copy_stmt)
+    return copy_stmt
+
+
+def staging_names(table) -> tuple:
+    """
+    Derive the names of the staging and retired copies of a table, in the same schema
+    :param table: name of the live table, optionally schema qualified
+    :return: tuple of (staging table, retired table), both schema qualified like `table`
+    """
+    schema, dot, name = table.rpartition('.')
+    return (
+        "{}{}{}_stage".format(schema, dot, name),
+        "{}{}{}_old".format(schema, dot, name),
+    )
+
+
+def prepare_staging(cursor, table, where=None) -> str:
+    """
+    Create an empty staging copy of a table.  When only a window of rows is replaced, the rows
+    outside of the window are carried over from the live table
+    :param cursor: pyodbc cursor
+    :param table: name of the live table
+    :param where: optional predicate of the rows that are going to be replaced
+    :return: name of the staging table
+    """
+    stage, old = staging_names(table)
+
+    # A previously failed load may have left its tables behind.  DDL commits in vertica, so this has to
+    # happen before the load rather than at swap time
+    cursor.execute("DROP TABLE IF EXISTS {stage}".format(stage=stage))
+    cursor.execute("DROP TABLE IF EXISTS {old}".format(old=old))
+    cursor.execute("CREATE TABLE {stage} LIKE {table} INCLUDING PROJECTIONS".format(stage=stage, table=table))
+    if where is not None:
+        cursor.execute("INSERT /*+ DIRECT */ INTO {stage} SELECT * FROM {table} WHERE NOT ({where})".format(
+            stage=stage, table=table, where=where))
+    return stage
+
+
+def swap_tables(cursor, tables) -> None:
+    """
+    Atomically replace live tables by their loaded staging copies and drop the previous versions.  The tables are
+    renamed by a single statement, readers see either all the old tables or all the new ones
+    :param cursor: pyodbc cursor
+    :param tables: names of the live tables
+    """
+    renames = [(table, ) + staging_names(table) for table in tables]
+    cursor.execute("ALTER TABLE {tables} RENAME TO {names}".format(
+        tables=", ".join("{}, {}".format(table, stage) for table, stage, _ in renames),
+        names=", ".join("{}, {}".format(old.rpartition('.')[2], table.rpartition('.')[2])
+                        for table, _, old in renames)
+    ))
+    for _, _, old in renames:
+        cursor.execute("DROP TABLE {old}".format(old=old))
 
 
-def connect(dsn) -> type:
+def high_water_mark(cursor, table, column):
     """
-    Obtain an ODBC cursor for vertica
+    Find the highest value of a column that has been loaded so far
+    :param cursor: pyodbc cursor
+    :param table: name of the table to inspect
+    :param column: column holding the high-water mark, usually a date
+    :return: the highest value or None when the table is empty
+    """
+    cursor.execute("SELECT MAX({column}) FROM {table}".format(column=column, table=table))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class ConnectionPool(object):
     """
-    cnxn = pyodbc.connect("DSN=%s" % dsn)
-    logger.info("Database connection established")
-    return cnxn.cursor()
+    Keep warm vertica connections around so that several jobs running in the same process can reuse them.
 
+    Connections are only opened when a cursor is requested, checked with a cheap query before being
+    handed out again and committed (or rolled back on error) when the cursor is returned::
 
-def write_to_file(df, load_path, filename="output.csv") -> str:
+        with pool.cursor() as cursor:
+            load(cursor, ...)
+    """
+    def __init__(self, dsn, size=4, connector=None):
+        """
+        :param dsn: ODBC data source name of the vertica cluster
+        :param size: maximum number of idle connections kept open
+        :param connector: callable returning a new connection, defaults to pyodbc.connect
+        """
+        self.dsn = dsn
+        self.size = size
+        self.connector = connector
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def acquire(self):
+        """
+        Get a healthy connection, reusing an idle one when possible
+        """
+        if self._closed:
+            raise RuntimeError("Connection pool for {} is closed".format(self.dsn))
+
+        while True:
+            try:
+                cnxn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self._healthy(cnxn):
+                return cnxn
+            self._discard(cnxn)
+
+        if self.connector is None:
+            # pyodbc is only imported once a connection is needed, it is slow to load
+            import pyodbc
+            self.connector = pyodbc.connect
+        cnxn = self.connector("DSN=%s" % self.dsn)
+        logger.info("Database connection established")
+        return cnxn
+
+    def release(self, cnxn) -> None:
+        """
+        Hand a connection back to the pool, it is closed if the pool is already full or closed
+        """
+        if self._closed:
+            self._discard(cnxn)
+            return
+
+        try:
+            self._idle.put_nowait(cnxn)
+        except queue.Full:
+            self._discard(cnxn)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """
+        Context manager lending a cursor on a pooled connection.  The transaction is committed when the
+        block succeeds and rolled back otherwise
+        """
+        cnxn = self.acquire()
+        cursor = cnxn.cursor()
+        try:
+            yield cursor
+            cnxn.commit()
+        except Exception:
+            cursor.close()
+            try:
+                cnxn.rollback()
+            except Exception:
+                # The connection is unusable, don't hand it out again
+                self._discard(cnxn)
+            else:
+                self.release(cnxn)
+            raise
+
+        cursor.close()
+        self.release(cnxn)
+
+    def close(self) -> None:
+        """
+        Close every idle connection, connections still in use are closed when they are released
+        """
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _healthy(self, cnxn) -> bool:
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute("SELECT 1").fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            logger.warning("Dropping unhealthy database connection")
+            return False
+
+    def _discard(self, cnxn) -> None:
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+
+
+def data_filename(filename, fmt) -> str:
+    """
+    Give a file name the extension of a format
+    """
+    if fmt == 'csv':
+        return filename
+    return filename.split('.')[0] + FORMATS[fmt]['extension']
+
+
+def concat_frames(frames):
+    """
+    Concatenate data frames (chunks of a CSV, apps...), pandas falls back to object columns when categoricals
+    don't share the same categories so those are made categorical again
+    :param frames: iterable of data frames
+    :return: single data frame
+    """
+    import pandas as pd
+
+    frames = list(frames)
+    df = pd.concat(frames)
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def write_to_file(df, load_path, filename="output.csv", fmt='csv') -> str:
     """
     Write a dataframe to local storage
     :param df: data frame containing the activity record
     :param load_path: local path to write the data to
-    :param filename: name of the file to save the output to
+    :param filename: name of the file to save the output to, its extension follows the format
+    :param fmt: format to write, one of FORMATS.  parquet and orc need pyarrow (the columnar
+                extra), orc also needs pandas 1.5 or later
     :return: fully resolved path to the output file
     """
-    data_file = os.path.join(load_path, filename)
+    if fmt not in FORMATS:
+        raise ValueError("Format must be one of {}, got {}".format(list(FORMATS), fmt))
+    data_file = os.path.join(load_path, data_filename(filename, fmt))
 
     if not os.path.exists(load_path):
         os.makedirs(load_path)
 
-    df.to_csv(data_file, index=False)
+    if fmt == 'csv':
+        df.to_csv(data_file, index=False)
+    elif fmt == 'csv.gz':
+        df.to_csv(data_file, index=False, compression='gzip')
+    elif fmt == 'parquet':
+        # A fresh RangeIndex is only kept as metadata and doesn't become a column
+        df.reset_index(drop=True).to_parquet(data_file)
+    else:
+        df.reset_index(drop=True).to_orc(data_file)
 
     return data_file
+
+
+def read_chunks(url, chunk_size=STREAM_CHUNK_SIZE, source=None, content_hash=None):
+    """
+    Read a remote resource in fixed size chunks without buffering the whole body
+    :param url: URL to read from, an already opened file-like object is read as-is
+    :param chunk_size: number of bytes to read at a time
+    :param source: name of the source whose fetch policy applies
+    :param content_hash: optional ContentHash recording the version of the response, see fetch.open_url
+    :return: generator of chunks
+    """
+    from collectors.fetch import open_url
+
+    with open_url(url, source=source, content_hash=content_hash) as body:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def stream_to_file(chunks, load_path, filename="output.csv", fmt='csv', content_hash=None) -> str:
+    """
+    Write a stream of chunks to local storage as they arrive.  Chunks can be raw CSV bytes/text or
+    data frames, in which case only the first one writes the CSV header
+    :param chunks: iterable of chunks
+    :param load_path: local path to write the data to
+    :param filename: name of the file to save the output to, its extension follows the format
+    :param fmt: one of STREAM_FORMATS
+    :param content_hash: optional ContentHash fed with the data as it is written
+    :return: fully resolved path to the output file
+    """
+    if fmt not in STREAM_FORMATS:
+        raise ValueError("Streams can only be written as {}, got {}".format(list(STREAM_FORMATS), fmt))
+    data_file = os.path.join(load_path, data_filename(filename, fmt))
+
+    if not os.path.exists(load_path):
+        os.makedirs(load_path)
+
+    # Nothing is overwritten when the stream fails before its first chunk, e.g. with fetch.NotModified
+    chunks = iter(chunks)
+    first = list(itertools.islice(chunks, 1))
+    header = True
+    with (gzip.open(data_file, 'wb') if fmt == 'csv.gz' else open(data_file, 'wb')) as f:
+        for chunk in itertools.chain(first, chunks):
+            if hasattr(chunk, 'to_csv'):
+                chunk = chunk.to_csv(index=False, header=header)
+                header = False
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if content_hash is not None:
+                content_hash.update(chunk)
+            f.write(chunk)
+
+    return data_file
+
+
+def stream_format(fmt) -> str:
+    """
+    Pick the format to stream in, columnar formats can't be written chunk by chunk and fall back to CSV
+    """
+    if fmt in STREAM_FORMATS:
+        return fmt
+    logger.warning("{} can't be streamed, falling back to csv".format(fmt))
+    return 'csv'
+
+
+class ContentHash(object):
+    """
+    Hash of a collected payload, computed while it is fetched and remembered per table in a state file under
+    the load path.  When a payload hashes the same as the one that was last loaded, writing and loading it
+    again can be skipped.
+    """
+    STATE_FILE = '.content_hashes.json'
+    # Keys of the state file holding the versions of the responses each table was last loaded from, and the
+    # digests of the parts of its payload
+    VERSIONS = '_versions'
+    PARTS = '_parts'
+
+    def __init__(self, load_path, table, salt='', force=False):
+        """
+        :param load_path: local path of the job, the state file lives there
+        :param table: name of the target table
+        :param salt: anything besides the payload that changes what gets loaded, e.g. an incremental window
+        :param force: never report the payload as unchanged, it is still hashed and saved
+        """
+        self.state_file = os.path.join(load_path, self.STATE_FILE)
+        self.table = table
+        self.force = force
+        self.salt = str(salt)
+        self.hasher = hashlib.sha256(self.salt.encode('utf-8'))
+        self.versions = set()
+        self.parts = {}
+        self.skipped = False
+
+    def update(self, data) -> None:
+        """
+        Add raw bytes of the payload
+        """
+        self.hasher.update(data)
+
+    def update_frame(self, df) -> None:
+        """
+        Add a data frame, hashed column-wise without rendering it
+        """
+        self.hasher.update(self.frame_digest(df))
+
+    @staticmethod
+    def frame_digest(df) -> bytes:
+        """
+        Digest of a data frame, frames can be hashed separately and fed to update() in a stable order
+        """
+        import pandas as pd
+
+        hasher = hashlib.sha256(",".join(str(c) for c in df.columns).encode('utf-8'))
+        hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        return hasher.digest()
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def _version_key(self, version) -> str:
+        return hashlib.sha256("{}\n{}".format(self.salt, version).encode('utf-8')).hexdigest()
+
+    def validated(self, version) -> None:
+        """
+        Record the version of a response the payload is read from, see fetch.validator
+        """
+        self.versions.add(self._version_key(version))
+
+    def loaded(self, version) -> bool:
+        """
+        Whether the last load of the table read a response of this version, its payload doesn't need to be read
+        again
+        """
+        if self.force:
+            return False
+        return self._version_key(version) in self._read_state().get(self.VERSIONS, {}).get(self.table, [])
+
+    def part_digest(self, digest) -> str:
+        """
+        Salt the digest of a part of the payload, e.g. the frame_digest of the file of one app
+        """
+        return hashlib.sha256(self.salt.encode('utf-8') + b"\n" + digest).hexdigest()
+
+    def loaded_part(self, name):
+        """
+        Salted digest of a part as it was last loaded into the table, None when it wasn't
+        """
+        if self.force:
+            return None
+        return self._read_state().get(self.PARTS, {}).get(self.table, {}).get(name)
+
+    def add_part(self, name, part_digest) -> None:
+        """
+        Add a named part of the payload, parts are added in a stable order
+        :param name: name of the part
+        :param part_digest: salted digest of the part, see part_digest and loaded_part
+        """
+        self.parts[name] = part_digest
+        self.hasher.update(part_digest.encode('utf-8'))
+
+    def skip(self) -> None:
+        """
+        Report the payload as unchanged without hashing it, all the responses it is made of were already loaded
+        """
+        self.skipped = True
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def unchanged(self) -> bool:
+        """
+        Whether the payload hashed so far is the one that was last loaded into the table
+        """
+        if self.force:
+            return False
+        return self.skipped or self._read_state().get(self.table) == self.hexdigest()
+
+    def save(self) -> None:
+        """
+        Remember the hash once the payload has been loaded
+        """
+        state = self._read_state()
+        state[self.table] = self.hexdigest()
+        state.setdefault(self.VERSIONS, {})[self.table] = sorted(self.versions)
+        state.setdefault(self.PARTS, {})[self.table] = self.parts
+
+        if not os.path.exists(os.path.dirname(self.state_file)):
+            os.makedirs(os.path.dirname(self.state_file))
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f)
@@ -0,0 +1,490 @@
+"""
+HTTP layer shared by the REST collectors: persistent keep-alive sessions, a conditional response cache, and a fetch
+policy (timeouts, retries, circuit breakers) per source
+"""
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import requests
+
+# Query parameters carrying credentials, they never reach the cache keys or the logs
+SECRET_PARAMS = ('api_key', 'user_token')
+DEFAULT_CACHE_MB = 1024
+CHUNK_SIZE = 1024 * 1024
+# Statuses worth retrying, only the ones telling that the request wasn't processed are retried for non-idempotent
+# methods
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+UNPROCESSED_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_cache = None
+_policies = {}
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def configure(settings=None) -> None:
+    """
+    Setup the HTTP layer from the `http` section of the configuration::
+
+        http:
+          cache_dir: /var/cache/data-collectors   # nothing is cached without it
+          cache_mb: 1024
+          read_timeout: 300                       # fetch policy of every source...
+          sources:
+            adjust:                               # ...unless overridden for a source
+              retries: 5
+
+    :param settings: dict of the response cache settings, the default fetch policy and the policies of the sources
+    """
+    global _cache
+    settings = settings or {}
+    if settings.get('cache_dir'):
+        _cache = ResponseCache(settings['cache_dir'], settings.get('cache_mb', DEFAULT_CACHE_MB))
+    else:
+        _cache = None
+
+    defaults = {k: v for k, v in settings.items() if k in FetchPolicy.DEFAULTS}
+    _policies.clear()
+    _policies[None] = FetchPolicy(**defaults)
+    for source, overrides in (settings.get('sources') or {}).items():
+        _policies[source] = FetchPolicy(**dict(defaults, **overrides))
+    with _hosts_lock:
+        _hosts.clear()
+
+
+def get_policy(source=None):
+    """
+    Fetch policy of a source, the default one for sources without their own
+    """
+    return _policies.get(source) or _policies.get(None) or FetchPolicy()
+
+
+def session() -> requests.Session:
+    """
+    Session of the current thread, its connections are kept alive from one request to the next
+    """
+    if getattr(_local, 'session', None) is None:
+        _local.session = requests.Session()
+    return _local.session
+
+
+class FetchPolicy(object):
+    """
+    Timeouts, retries and circuit breaking of the requests made to a source
+    """
+    DEFAULTS = dict(
+        connect_timeout=10,      # seconds to establish a connection
+        read_timeout=300,        # seconds without receiving a byte
+        retries=3,               # retries of a single request
+        backoff_secs=1,          # retries wait a random time up to backoff_secs * 2 ** attempt...
+        max_backoff_secs=60,     # ...capped at max_backoff_secs
+        retry_budget=0.2,        # retries to a host never exceed min_retries + retry_budget * requests to it
+        min_retries=10,
+        failure_threshold=5,     # consecutive failures opening the circuit breaker of a host
+        reset_secs=60,           # seconds before an open circuit breaker lets a trial request through
+    )
+
+    def __init__(self, **settings):
+        unknown = set(settings) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown fetch policy settings: {}".format(sorted(unknown)))
+        for name, default in self.DEFAULTS.items():
+            setattr(self, name, settings.get(name, default))
+
+    def timeout(self) -> tuple:
+        return self.connect_timeout, self.read_timeout
+
+    def backoff(self, attempt) -> float:
+        """
+        Full jitter exponential backoff before a retry
+        """
+        return random.uniform(0, min(self.max_backoff_secs, self.backoff_secs * 2 ** attempt))
+
+
+class RetryBudget(object):
+    """
+    Bound the retries sent to a host to a share of the requests made to it, so that retries don't pile up on an
+    upstream that is struggling
+    """
+    def __init__(self, ratio, min_retries):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def try_retry(self) -> bool:
+        """
+        Spend a retry if the budget allows it
+        """
+        with self.lock:
+            if self.retries >= self.min_retries + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast once a host keeps failing: after failure_threshold consecutive failures the circuit opens and no
+    request is sent for reset_secs, then a single trial request decides whether it closes again
+    """
+    def __init__(self, failure_threshold, reset_secs):
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_secs:
+                # Half open: let this request through and hold the others until it is done
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of sending a request to a host whose circuit breaker is open
+    """
+
+
+def host_state(host, policy) -> tuple:
+    """
+    Retry budget and circuit breaker of a host, created with the policy of the first request sent to it
+    """
+    with _hosts_lock:
+        if host not in _hosts:
+            _hosts[host] = (RetryBudget(policy.retry_budget, policy.min_retries),
+                            CircuitBreaker(policy.failure_threshold, policy.reset_secs))
+        return _hosts[host]
+
+
+def request(method, url, source=None, **kwargs) -> requests.Response:
+    """
+    Send a request under the fetch policy of its source: connect and read timeouts, jittered exponential retries
+    of connection errors and 5xx/429 replies within the retry budget of the host, and its circuit breaker
+    :param method: HTTP method
+    :param url: requested URL
+    :param source: name of the source (adjust, redash...) whose policy applies
+    :param kwargs: arguments of requests.Session.request
+    :return: the response, possibly an error one once the retries are exhausted
+    """
+    policy = get_policy(source)
+    host = urllib.parse.urlsplit(url).netloc
+    budget, breaker = host_state(host, policy)
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    budget.request()
+
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpen("Circuit breaker of {} is open, not sending {} {}".format(
+                host, method, strip_secrets(url)))
+
+        response, error, retry_after = None, None, None
+        try:
+            response = session().request(method, url, timeout=policy.timeout(), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.failure()
+            error = e
+            retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                breaker.success()
+                return response
+            if response.status_code >= 500:
+                breaker.failure()
+            retryable = idempotent or response.status_code in UNPROCESSED_STATUSES
+            retry_after = response.headers.get('Retry-After')
+
+        if not retryable or attempt >= policy.retries or not budget.try_retry():
+            if error is not None:
+                raise error
+            return response
+
+        wait = policy.backoff(attempt)
+        if retry_after is not None and retry_after.isdigit():
+            wait = min(max(wait, int(retry_after)), policy.max_backoff_secs)
+        logger.warning("{} {} failed ({}), retrying in {:.1f}s".format(
+            method, strip_secrets(url), error or response.status_code, wait))
+        if response is not None:
+            response.close()
+        time.sleep(wait)
+        attempt += 1
+
+
+def strip_secrets(url) -> str:
+    """
+    Remove the credentials from the query string of a URL
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+             if k not in SECRET_PARAMS]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of response bodies with their validators, bounded in size by evicting the least recently
+    used entries.  Every entry is a pair of files named after the URL without its secrets: <key>.json holds
+    the validators and <key>.body the response body.
+    """
+
+    def __init__(self, path, max_mb=DEFAULT_CACHE_MB):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, url) -> str:
+        return hashlib.sha1(strip_secrets(url).encode('utf-8')).hexdigest()
+
+    def paths(self, key) -> tuple:
+        return os.path.join(self.path, key + '.json'), os.path.join(self.path, key + '.body')
+
+    def lookup(self, url):
+        """
+        Find the cache entry of a URL
+        :return: dict with the etag, last_modified and body path of the entry, None when there is none
+        """
+        meta_path, body_path = self.paths(self.key(url))
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        meta['body'] = body_path
+        return meta
+
+    def touch(self, url) -> None:
+        """
+        Mark the entry of a URL as recently used
+        """
+        meta_path, _ = self.paths(self.key(url))
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            pass
+
+    def tee(self, url, response) -> io.BufferedReader:
+        """
+        Read the body of a response while copying it to the cache, the entry is only stored once the body has
+        been read to the end
+        :param url: requested URL
+        :param response: streamed requests.Response
+        :return: binary file-like object of the body
+        """
+        return io.BufferedReader(CachingReader(self, url, response), CHUNK_SIZE)
+
+    def commit(self, url, response, body_tmp) -> str:
+        """
+        Store a fully read body along with the validators of its response
+        :param url: requested URL
+        :param response: requests.Response the body was read from
+        :param body_tmp: temporary file holding the body, it is moved into the cache
+        :return: path to the cached body
+        """
+        key = self.key(url)
+        meta_path, body_path = self.paths(key)
+        os.replace(body_tmp, body_path)
+
+        meta = dict(url=strip_secrets(url), etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'), size=os.path.getsize(body_path))
+        self._write(meta_path, lambda f: json.dump(meta, f), 'w')
+        self.evict(keep=key)
+        return body_path
+
+    def _write(self, path, writer, mode) -> None:
+        """
+        Write a file atomically, readers never see it half written
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                writer(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def evict(self, keep=None) -> None:
+        """
+        Remove the least recently used entries until the cache fits in its size bound
+        :param keep: key of an entry that must not be evicted
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if not name.endswith('.json'):
+                    continue
+                key = name[:-len('.json')]
+                meta_path, body_path = self.paths(key)
+                try:
+                    entries.append((os.path.getmtime(meta_path), os.path.getsize(body_path), key))
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                for path in self.paths(key):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                total -= size
+                logger.debug("Evicted {} from the response cache".format(key))
+
+
+class CachingReader(io.RawIOBase):
+    """
+    Raw reader of a response body copying what it reads to a temporary file of the cache.  The copy becomes a
+    cache entry when the reader is closed after reaching the end of the body, and is dropped otherwise.
+    """
+
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        response.raw.decode_content = True
+        fd, self.tmp = tempfile.mkstemp(dir=cache.path, suffix='.tmp')
+        self.copy = os.fdopen(fd, 'wb')
+        self.complete = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.response.raw.read(len(buffer))
+        if not data:
+            self.complete = True
+            return 0
+        buffer[:len(data)] = data
+        self.copy.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.copy.close()
+            if self.complete:
+                self.cache.commit(self.url, self.response, self.tmp)
+            else:
+                os.remove(self.tmp)
+        super().close()
+
+
+class NotModified(Exception):
+    """
+    Raised by open_url instead of reading a cached body back when the server answers 304 for a response that
+    was already loaded
+    """
+
+
+def validator(url, headers) -> str:
+    """
+    Identify a version of a resource by its URL without secrets and the validators of its response
+    :param headers: response headers, or cache entry, with its ETag and Last-Modified
+    """
+    etag = headers.get('ETag', headers.get('etag'))
+    last_modified = headers.get('Last-Modified', headers.get('last_modified'))
+    if not etag and not last_modified:
+        return None
+    return "{} {} {}".format(strip_secrets(url), etag or '', last_modified or '')
+
+
+def conditional_headers(entry) -> dict:
+    """
+    Request headers revalidating a cache entry
+    """
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+@contextlib.contextmanager
+def open_url(url, cache=None, source=None, content_hash=None):
+    """
+    Open a remote resource for reading.  Responses carrying an ETag or a Last-Modified header are copied to the
+    response cache while they are read, and revalidated on the next request.  A 304 reply is served from disk
+    without transferring the body again, or skipped altogether when it is for the version that was last loaded.
+    :param url: URL to read from, an already opened file-like object is passed through as-is
+    :param cache: ResponseCache to use instead of the configured one
+    :param source: name of the source whose fetch policy applies
+    :param content_hash: optional ContentHash of the load, the validators of the responses are recorded in it
+    :return: context manager of a binary file-like object
+    :raises NotModified: on a 304 reply for a version content_hash already loaded
+    """
+    if not isinstance(url, str):
+        yield url
+        return
+
+    cache = cache or _cache
+    entry = cache.lookup(url) if cache is not None else None
+    response = request('GET', url, source, headers=conditional_headers(entry), stream=True)
+    try:
+        if response.status_code == 304 and entry is not None:
+            cache.touch(url)
+            version = validator(url, entry)
+            if content_hash is not None and version is not None:
+                content_hash.validated(version)
+                if content_hash.loaded(version):
+                    logger.info("{} is not modified since the last load".format(strip_secrets(url)))
+                    raise NotModified(strip_secrets(url))
+            logger.info("{} is not modified, reading it from the cache".format(strip_secrets(url)))
+            body = open(entry['body'], 'rb')
+        else:
+            response.raise_for_status()
+            version = validator(url, response.headers)
+            if content_hash is not None and version is not None:
+                content_hash.validated(version)
+            if cache is not None and version is not None:
+                body = cache.tee(url, response)
+            else:
+                response.raw.decode_content = True
+                body = response.raw
+
+        with body:
+            yield body
+    finally:
+        response.close()
@@ -1,15 +1,58 @@
+import importlib
 import json
 import logging
 import logging.config
 import os
 
 import click
-import pkg_resources
 import yaml
 
+DEFAULT_LOG_CONFIG = os.path.join(os.path.dirname(__file__), 'defaults', 'default_log_config.yml')
+
+# Subcommands, the "module:command" they live in and their short help.  Modules are only imported when their command
+# runs so that pandas, pyodbc and friends don't slow down every invocation
+SUBCOMMANDS = {
+    'adjust': ('collectors.adjust:adjust_cmd', "Collect adjust.com KPIs"),
+    'redash': ('collectors.redash:redash_cmd', "Collect the results of a redash query"),
+    'run-batch': ('collectors.batch:batch_cmd', "Run every job listed in a YAML manifest"),
+    's3': ('collectors.s3_fetcher:s3_cmd', "Stream an S3 object into vertica"),
+}
+
 logger = logging.getLogger(__name__)
 
 
+class LazyGroup(click.Group):
+    """
+    Group importing the module of a subcommand only when that subcommand is looked up
+    """
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx) -> list:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            module, name = self.lazy_subcommands[cmd_name][0].split(':')
+            self.add_command(getattr(importlib.import_module(module), name), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter) -> None:
+        """
+        List the subcommands with their declared help, without importing them
+        """
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_subcommands and name not in self.commands:
+                rows.append((name, self.lazy_subcommands[name][1]))
+            else:
+                rows.append((name, self.get_command(ctx, name).get_short_help_str()))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
 def load_yaml(ctx, param, yaml_file) -> dict:
     """
     Load settings for the collectors
@@ -39,17 +82,15 @@ def setup_logging(logging_config=None) -> dict:
         else:
             raise Exception("%s is not a supported extension" % extension)
     else:
-        pkg = __name__
-        path = '/'.join(('defaults', 'default_log_config.yml'))
-        with pkg_resources.resource_stream(pkg, path) as f:
-            config = yaml.load(f)
+        with open(DEFAULT_LOG_CONFIG, 'r') as f:
+            config = yaml.safe_load(f)
 
     logging.config.dictConfig(config)
     logger.info("Logging configured")
     return config
 
 
-@click.group()
+@click.group(cls=LazyGroup, lazy_subcommands=SUBCOMMANDS)
 @click.option("--log-conf", type=click.Path(exists=True, readable=True),
               help="Path to YAML logging configuration", default=None)
 @click.option("--config", callback=load_yaml, default="/etc/data-collectors/data-collectors.yml",
@@ -59,14 +100,20 @@ def cli(ctx, log_conf, config) -> None:
     """
     Main entry point for the collectors
     """
+    from collectors import fetch, metrics
+    from collectors.common import ConnectionPool
+
     setup_logging(log_conf)
     ctx.obj['config'] = config
+    fetch.configure(config.get('http'))
+    metrics.configure(config.get('metrics'))
 
+    # Share warm vertica connections between everything that runs in this process
+    if 'vertica' in config:
+        pool = ConnectionPool(config['vertica']['dsn'], config['vertica'].get('pool_size', 4))
+        ctx.obj['pool'] = pool
+        ctx.call_on_close(pool.close)
 
-if __name__ == "__main__":
-    from collectors.adjust import adjust_cmd
-    from collectors.redash import redash_cmd
 
-    cli.add_command(adjust_cmd)
-    cli.add_command(redash_cmd)
+if __name__ == "__main__":
     cli(obj={})
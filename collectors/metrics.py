@@ -0,0 +1,232 @@
+"""
+Wall time, volume and memory of the stages (fetch, serialize, load) of every collector run.  They are logged as JSON
+lines on the `collectors.metrics` logger and optionally exported as a Prometheus textfile.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+PROMETHEUS_PREFIX = 'data_collectors'
+# Rotation of the JSON lines log file, like the log files of the default logging configuration
+LOG_FILE_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 20
+LABEL_VALUE = r'"((?:[^"\\]|\\.)*)"'
+SAMPLE = re.compile(PROMETHEUS_PREFIX + r'_(\w+)\{collector=' + LABEL_VALUE + ',table=' + LABEL_VALUE +
+                    ',stage=' + LABEL_VALUE + r'\} (\S+)$')
+# Descriptions of the metrics in the textfile, the other fields are described by their name
+HELP = {
+    'secs': "Wall time of the stage in seconds",
+    'rows': "Rows processed by the stage",
+    'bytes': "Bytes processed by the stage",
+    'peak_rss_bytes': "Peak resident set size of the process at the end of the stage",
+    'failed': "1 when the run failed",
+}
+
+logger = logging.getLogger(__name__)
+
+_textfile = None
+_log_handler = None
+_lock = threading.Lock()
+
+
+def configure(settings=None) -> None:
+    """
+    Setup the metrics from the `metrics` section of the configuration
+    :param settings: dict with the path of the Prometheus textfile and of the JSON lines log file, neither is
+                     written without its path
+    """
+    global _textfile, _log_handler
+    settings = settings or {}
+    _textfile = settings.get('textfile')
+
+    if _log_handler is not None:
+        logger.removeHandler(_log_handler)
+        _log_handler.close()
+        _log_handler = None
+    if settings.get('log_file'):
+        _log_handler = logging.handlers.RotatingFileHandler(settings['log_file'], maxBytes=LOG_FILE_BYTES,
+                                                            backupCount=LOG_FILE_BACKUPS, encoding='utf8')
+        _log_handler.setFormatter(JsonFormatter())
+        logger.addHandler(_log_handler)
+        if logger.level == logging.NOTSET:
+            # The metrics are logged at INFO, a logging configuration that doesn't mention them must not drop them
+            logger.setLevel(logging.INFO)
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of the process so far, in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Render log records as one JSON object per line, the metrics attached to a record become fields of it
+    """
+    def format(self, record) -> str:
+        payload = OrderedDict([
+            ('time', self.formatTime(record)),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('message', record.getMessage()),
+        ])
+        payload.update(getattr(record, 'metrics', {}))
+        return json.dumps(payload)
+
+
+class RunMetrics(object):
+    """
+    Metrics of a single collector run, emitted when the run ends::
+
+        with RunMetrics('redash', table) as metrics:
+            with metrics.stage('load') as stage:
+                stage['rows'] = load(...)
+
+    A stage entered several times, e.g. once per app by concurrent workers, adds up: its secs are the time spent
+    in it across threads.  Peak RSS is process-wide, jobs of a batch running at the same time share it.
+    """
+
+    def __init__(self, collector, table=None):
+        self.collector = collector
+        self.table = table
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.status = 'ok'
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.emit('failed' if exc_type is not None else self.status)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage, the yielded dict takes its rows, bytes or any other count
+        """
+        fields = {}
+        started = time.time()
+        try:
+            yield fields
+        finally:
+            self.record(name, secs=time.time() - started, **fields)
+
+    def record(self, name, **fields) -> None:
+        """
+        Add counts to a stage, fields named max_* keep their maximum instead of adding up.  Anything but numbers
+        (e.g. an unknown count left to None) is ignored
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, OrderedDict())
+            for field, value in fields.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                if field.startswith('max_'):
+                    stage[field] = max(stage.get(field, value), value)
+                else:
+                    stage[field] = stage.get(field, 0) + value
+            stage['peak_rss_bytes'] = peak_rss()
+
+    def summary(self, status='ok') -> list:
+        """
+        One dict per stage followed by the total of the run
+        """
+        base = OrderedDict([('collector', self.collector), ('table', self.table)])
+        rows = [OrderedDict(base, stage=name, **fields) for name, fields in self.stages.items()]
+        rows.append(OrderedDict(base, stage='total', status=status, secs=time.time() - self.started,
+                                peak_rss_bytes=peak_rss()))
+        return rows
+
+    def emit(self, status='ok') -> None:
+        """
+        Log the metrics of the run and update the Prometheus textfile
+        """
+        rows = self.summary(status)
+        for row in rows:
+            logger.info("{collector} {table} {stage}".format(**row), extra={'metrics': row})
+        if _textfile:
+            write_textfile(_textfile, rows)
+
+
+def escape_label(value) -> str:
+    """
+    Escape a label value of the Prometheus text format
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def unescape_label(value) -> str:
+    """
+    Read back a label value escaped by escape_label
+    """
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), value)
+
+
+def read_textfile(path) -> OrderedDict:
+    """
+    Samples of a Prometheus textfile written by `write_textfile`, by (collector, table, stage)
+    :return: empty when the file does not exist yet
+    """
+    samples = OrderedDict()
+    if not os.path.exists(path):
+        return samples
+    with open(path) as f:
+        for line in f:
+            match = SAMPLE.match(line.strip())
+            if match:
+                field, collector, table, stage, value = match.groups()
+                labels = tuple(unescape_label(label) for label in (collector, table, stage))
+                samples.setdefault(labels, OrderedDict())[field] = value
+    return samples
+
+
+def write_textfile(path, rows) -> None:
+    """
+    Merge the metrics of a run with the ones already in the textfile, which collectors and tables that run in other
+    processes write too, and write them in the Prometheus text format.  The merge holds a lock on `<path>.lock` and
+    the file is replaced atomically so that the node exporter never reads half a file
+    """
+    with _lock, open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        samples = read_textfile(path)
+        for row in rows:
+            labels = (row['collector'], row['table'] or '', row['stage'])
+            samples[labels] = OrderedDict((k, v) for k, v in row.items()
+                                          if k not in ('collector', 'table', 'stage') and isinstance(v, (int, float)))
+            if 'status' in row:
+                samples[labels]['failed'] = int(row['status'] == 'failed')
+
+        # The samples of a metric follow its HELP and TYPE lines
+        metrics = OrderedDict()
+        for (collector, table, stage), values in samples.items():
+            labels = 'collector="{}",table="{}",stage="{}"'.format(
+                escape_label(collector), escape_label(table), escape_label(stage))
+            for field, value in values.items():
+                metrics.setdefault(field, []).append("{}_{}{{{}}} {}".format(PROMETHEUS_PREFIX, field, labels, value))
+
+        lines = []
+        for field, metric_samples in metrics.items():
+            name = "{}_{}".format(PROMETHEUS_PREFIX, field)
+            lines.append("# HELP {} {}".format(name, HELP.get(field, field.replace('_', ' ').capitalize())))
+            lines.append("# TYPE {} gauge".format(name))
+            lines += metric_samples
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        # mkstemp creates the file for its owner only, the node exporter may run as another user
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
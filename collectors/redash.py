@@ -1,40 +1,224 @@
 import logging
 import os
+import time
 
 import click
 import pandas as pd
 
-from collectors.common import connect, load, write_to_file
+from collectors import fetch
+from collectors.common import load, write_to_file, read_chunks, stream_to_file, stream_format, ContentHash, \
+    concat_frames, DEFAULT_CHUNKSIZE, STREAM_FORMATS
+from collectors.metrics import RunMetrics
 
-REDASH_URL_TMPL = "https://sql.telemetry.mozilla.org/api/queries/{query_id}/results.csv?api_key={api_key}"
+REDASH_BASE_URL = "https://sql.telemetry.mozilla.org"
+REDASH_URL_TMPL = "{base_url}/api/queries/{query_id}/results.csv?api_key={api_key}"
+REDASH_RESULT_URL_TMPL = "{base_url}/api/query_results/{result_id}.csv?api_key={api_key}"
+MAX_POLL_INTERVAL = 30
+DEFAULT_REFRESH_TIMEOUT = 3600
+
+# Status codes of redash jobs
+JOB_SUCCESS = 3
+JOB_FAILURE = 4
+JOB_CANCELLED = 5
 
 logger = logging.getLogger(__name__)
 
 
+def run(config, pool, table, api_key, query_id, stream=False, load_path=None, force=False, refresh=False,
+        max_age=0, dtypes=None, parse_dates=None) -> dict:
+    """
+    Collect the results of a redash query and load them into vertica
+    :param config: base configuration of the collectors
+    :param pool: ConnectionPool used to reach vertica
+    :param table: name of the target table
+    :param load_path: local path to write the data to, defaults to a directory named after the query
+    :param force: load the data even if it is the same as the last load
+    :param refresh: run the query through the refresh API instead of downloading its last cached result
+    :param max_age: when refreshing, seconds for which a cached result is still fresh enough to be reused
+    :param dtypes: optional dict of pandas dtypes of the result columns
+    :param parse_dates: optional list of the result columns holding dates
+    :return: summary of the run: rows, bytes and seconds spent fetching and loading, skipped when the data
+             was unchanged
+    """
+    query_id = str(query_id)
+
+    # Setup the load path
+    if load_path is None:
+        load_path = os.path.join(config['data_dir'], "redash", query_id)
+    reject_file = os.path.join(load_path, "rejects")
+    exception_file = os.path.join(load_path, "exceptions")
+
+    settings = config.get('redash', {})
+    base_url = settings.get('url', REDASH_BASE_URL)
+
+    fmt = config.get('data_format', 'csv')
+    if stream:
+        fmt = stream_format(fmt)
+
+    with RunMetrics('redash', table) as run_metrics:
+        started = time.time()
+        if refresh:
+            with run_metrics.stage('refresh'):
+                result_id = refresh_query(base_url, api_key, query_id, max_age,
+                                          timeout=settings.get('refresh_timeout', DEFAULT_REFRESH_TIMEOUT))
+            query_url = REDASH_RESULT_URL_TMPL.format(base_url=base_url, result_id=result_id, api_key=api_key)
+        else:
+            query_url = REDASH_URL_TMPL.format(base_url=base_url, query_id=query_id, api_key=api_key)
+        content_hash = ContentHash(load_path, table, force=force)
+        output_path = collect(query_url, load_path, stream, fmt, content_hash, dtypes, parse_dates,
+                              metrics=run_metrics)
+        fetched = time.time()
+
+        if content_hash.unchanged():
+            logger.info("{table} is unchanged since the last load, skipping it".format(table=table))
+            run_metrics.status = 'unchanged'
+            return {'rows': 0, 'bytes': None, 'fetch_secs': fetched - started, 'load_secs': 0, 'skipped': True}
+
+        swap = config['vertica'].get('swap', False)
+        with run_metrics.stage('load') as stage, pool.cursor() as cursor:
+            stage['rows'] = load(cursor, table, output_path, reject_file, exception_file, swap=swap, fmt=fmt)
+            stage['bytes'] = os.path.getsize(output_path)
+        content_hash.save()
+
+        return {
+            'rows': stage['rows'],
+            'bytes': stage['bytes'],
+            'fetch_secs': fetched - started,
+            'load_secs': time.time() - fetched,
+        }
+
+
 @click.command('redash')
 @click.option("--table", type=str, required=True, help="Name of the target table where the load should be persisted")
 @click.option("--api-key", type=str, required=True, help="API Key associated with the redash query")
 @click.option("--query_id", type=str, required=True, help="Query ID")
+@click.option("--stream", is_flag=True, default=False,
+              help="Stream the result straight to the load file instead of parsing it with pandas")
+@click.option("--force", is_flag=True, default=False, help="Load the data even if it didn't change since the last load")
+@click.option("--refresh", is_flag=True, default=False,
+              help="Run the query through the refresh API instead of downloading its last cached result")
+@click.option("--max-age", type=int, default=0,
+              help="When refreshing, reuse a cached result younger than this many seconds")
 @click.pass_context
-def redash_cmd(ctx, table, api_key, query_id) -> None:
-    # Setup the load path
-    data_dir = ctx.obj['config']['data_dir']
-    load_path = os.path.join(data_dir, "redash", query_id)
+def redash_cmd(ctx, table, api_key, query_id, stream, force, refresh, max_age) -> None:
+    run(ctx.obj['config'], ctx.obj['pool'], table, api_key, query_id, stream, force=force, refresh=refresh,
+        max_age=max_age)
 
-    # Grab a vertica connection
-    cursor = connect(ctx.obj['config']['vertica']['dsn'])
-    reject_file = os.path.join(load_path, "rejects")
-    exception_file = os.path.join(load_path, "exceptions")
 
-    query_url = REDASH_URL_TMPL.format(query_id=query_id, api_key=api_key)
+def refresh_query(base_url, api_key, query_id, max_age=0, poll_interval=1, max_interval=MAX_POLL_INTERVAL,
+                  timeout=DEFAULT_REFRESH_TIMEOUT) -> int:
+    """
+    Refresh a query and wait for its result.  The job is polled every poll_interval seconds at first, the wait
+    doubling up to max_interval.
+    :param base_url: URL of the redash server
+    :param api_key: API Key associated with the redash query
+    :param query_id: Query ID
+    :param max_age: seconds for which a cached result is fresh enough to be reused, 0 always runs the query
+    :param timeout: seconds to wait for the job before giving up
+    :return: id of the query result
+    """
+    params = {'api_key': api_key}
+
+    response = fetch.request('POST', "{}/api/queries/{}/results".format(base_url, query_id), 'redash',
+                             params=params, json={'max_age': max_age})
+    response.raise_for_status()
+    payload = response.json()
+    if 'query_result' in payload:
+        logger.info("Reusing result {} of query {}".format(payload['query_result']['id'], query_id))
+        return payload['query_result']['id']
+
+    job = payload['job']
+    started = time.time()
+    interval = poll_interval
+    while job['status'] not in (JOB_SUCCESS, JOB_FAILURE, JOB_CANCELLED):
+        if time.time() - started > timeout:
+            raise TimeoutError("Refresh of query {} still running after {}s".format(query_id, timeout))
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+        response = fetch.request('GET', "{}/api/jobs/{}".format(base_url, job['id']), 'redash', params=params)
+        response.raise_for_status()
+        job = response.json()['job']
+
+    if job['status'] != JOB_SUCCESS:
+        raise RuntimeError("Refresh of query {} failed: {}".format(query_id, job.get('error')))
+    logger.info("Query {} refreshed in {:.1f}s".format(query_id, time.time() - started))
+    return job['query_result_id']
+
+
+def parse_chunks(reader, content_hash=None, metrics=None):
+    """
+    Parse a CSV chunk by chunk, each chunk is hashed as soon as it is parsed
+    :param reader: pandas reader of the CSV
+    :param content_hash: optional ContentHash fed with the chunks
+    :param metrics: optional RunMetrics, parsing counts as fetching and what the consumer does with a chunk as
+                    serializing
+    :return: generator of DataFrame chunks
+    """
+    metrics = metrics or RunMetrics('redash')
+    chunks = iter(reader)
+    while True:
+        with metrics.stage('fetch') as stage:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            stage['rows'] = len(chunk)
+        if content_hash is not None:
+            content_hash.update_frame(chunk)
+        with metrics.stage('serialize'):
+            yield chunk
+
 
-    output_path = collect(query_url, load_path)
-    load(cursor, table, output_path, reject_file, exception_file)
+def collect(url, load_path, stream=False, fmt='csv', content_hash=None, dtypes=None, parse_dates=None,
+            chunksize=DEFAULT_CHUNKSIZE, metrics=None) -> str:
+    """
+    Collect the results of a redash query
+    :param url: URL of the CSV results
+    :param load_path: local path to write the data to
+    :param stream: copy the response body to disk chunk by chunk, memory stays flat whatever the result size
+    :param fmt: format of the output file
+    :param content_hash: optional ContentHash of the collected data.  Nothing is read when redash answers the
+                         result that was last loaded is not modified
+    :param dtypes: optional dict of pandas dtypes of the columns, the others are inferred
+    :param parse_dates: optional list of the columns holding dates
+    :param chunksize: number of rows parsed at a time.  CSV files are written chunk by chunk, columnar ones need
+                      the whole result in memory
+    :param metrics: optional RunMetrics recording the fetch and serialize stages
+    :return: fully resolved path to the output file, None when it was not written or the data is unchanged
+    """
+    metrics = metrics or RunMetrics('redash')
+    try:
+        if stream:
+            # Fetching and writing are interleaved, the whole stream counts as fetching
+            with metrics.stage('fetch') as stage:
+                chunks = read_chunks(url, source='redash', content_hash=content_hash)
+                output_path = stream_to_file(chunks, load_path, fmt=fmt, content_hash=content_hash)
+                stage['bytes'] = os.path.getsize(output_path)
+            return output_path
 
+        with fetch.open_url(url, source='redash', content_hash=content_hash) as body:
+            reader = pd.read_csv(body, sep=',', dtype=dtypes, parse_dates=parse_dates or False, chunksize=chunksize)
+            if fmt in STREAM_FORMATS:
+                # Only one chunk is in memory at a time.  Unchanged data is written again, to the same bytes
+                output_path = stream_to_file(parse_chunks(reader, content_hash, metrics), load_path, fmt=fmt)
+                metrics.record('serialize', bytes=os.path.getsize(output_path))
+                return None if content_hash is not None and content_hash.unchanged() else output_path
 
-def collect(url, load_path) -> str:
-    df = pd.read_csv(url, sep=',')
-    return write_to_file(df, load_path)
+            with metrics.stage('fetch') as stage:
+                df = concat_frames(reader)
+                stage['rows'] = len(df)
+    except fetch.NotModified:
+        # The result that was last loaded, it is neither parsed nor written again
+        content_hash.skip()
+        return None
+    if content_hash is not None:
+        content_hash.update_frame(df)
+        if content_hash.unchanged():
+            return None
+    with metrics.stage('serialize') as stage:
+        output_path = write_to_file(df, load_path, fmt=fmt)
+        stage['bytes'] = os.path.getsize(output_path)
+    return output_path
 
 
 if __name__ == '__main__':
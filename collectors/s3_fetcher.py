@@ -7,9 +7,32 @@
 # to be downloaded without requiring large amounts of memory, and
 # improves performance by downloading multiple parts in parallel.
 #
+# Parts are written to the output file in order.  Parts that complete
+# ahead of the next one to write wait in a reorder buffer; the number of
+# bytes downloading or waiting is bounded by --max_buffer_mb.
+#
+# Objects that were not uploaded in multiple parts, or any object when
+# --range_mb is given, are split into byte ranges of that size and fetched
+# with ranged GETs.  The ETag is checked against digests computed while
+# the parts are written, the file is never read back.
+#
+# The "s3" subcommand of data-collectors streams the ordered parts, gzip
+# or bz2 decompressed on the fly, straight into a vertica COPY.
+#
+# With --resume the object is always split in byte ranges (of --range_mb,
+# 16 MB by default) since the parts of a multipart upload can have unequal
+# sizes.  The output file is preallocated and every range is written at its
+# offset as soon as it arrives, so at most threads x range size bytes are
+# held in memory.  Finished parts are recorded in output_file.parts; an
+# interrupted download started again with --resume only fetches the parts
+# that are missing.  The finished file is hashed back to check it against
+# the ETag of objects uploaded in one part; downloads of multipart uploads
+# can't be verified with --resume.
+#
 # Usage:
 #   s3_fetch -p aws_profile -f output_file -b s3_bucket -s s3_key
-#          [-m metadata_file] [-t threads] [-d debug_level]
+#          [-m metadata_file] [-t threads] [-x max_buffer_mb]
+#          [-r retries] [-c range_mb] [--resume] [-d debug_level]
 #
 # Parameter descriptions:
 #   aws_profile:   name of your AWS profile
@@ -17,6 +40,11 @@
 #   s3_bucket:     name of the S3 bucket where your object exists
 #   s3_key:        key (path/name) of the S3 object to be downloaded
 #   metadata_file: write S3 object metadata, if it exists, to this file
+#   threads:       number of parts downloaded in parallel, default is 5
+#   max_buffer_mb: limit on the bytes in flight, default is 512
+#   retries:       attempts per part before giving up, default is 3
+#   range_mb:      download byte ranges of this size instead of the upload
+#                  parts, default is 16 for objects uploaded in one part
 #   debug_level:   default is INFO
 #
 # Examples:
@@ -28,163 +56,672 @@ from __future__ import print_function
 import os
 import sys
 import argparse
+import bz2
+import hashlib
 import logging
 import time as t
-import datetime as dt
-import base64
 import json
 import threading
-import gc
-import traceback
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import boto3
-import botocore
+import click
 
 from botocore.client import Config
 
+from collectors.common import load
+from collectors.metrics import RunMetrics
+
+DEFAULT_THREADS = 5
+DEFAULT_MAX_BUFFER_MB = 512
+DEFAULT_RETRIES = 3
+DEFAULT_RANGE_MB = 16
+# Size of the reads hashing a resumable download back
+VERIFY_BLOCK_BYTES = 8 * 1024 * 1024
+RETRY_BACKOFF_SECS = 1
+COMPRESSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.bz2': 'bz2'}
+
+
 class ReadException(Exception):
     pass
 
-def main():
-    class Parts(object):
-        ''' Download an S3 object in multiple parts, each in a different
+
+def current_ts():
+    return t.time()
+
+
+class Parts(object):
+    ''' Download an S3 object in multiple parts, each in a different thread,
+        and write them to a file in order.
+    '''
+    def __init__(self, s3, bucket, s3_key, num_s3_parts, fout,
+                 part_size=None, threads=DEFAULT_THREADS,
+                 max_buffer_bytes=DEFAULT_MAX_BUFFER_MB * 1024 * 1024,
+                 retries=DEFAULT_RETRIES, ranges=False, etag=None):
+        ''' part_size is the size of the first part, all the parts but the
+            last one have the same size.  Together with max_buffer_bytes it
+            sets how many parts can be downloading or waiting to be written.
+            With ranges, parts are byte ranges of part_size rather than the
+            parts of a multipart upload.  The digests needed to check etag
+            are computed as the parts go by.
         '''
-        def __init__(self):
-            self.num_s3_parts = int(s3_object['PartsCount'])
-            self.max_running = args.threads
-            logging.info("S3 object parts: %d" % self.num_s3_parts)
-            logging.info("Max running threads: %d" % self.max_running)
-            self.parts = ['0-index not used']  # S3 part numbers are 1-relative
-            self.total_size_read = 0
-            self.total_read_secs = 0
-            self.max_read_secs = 0
-
-        def num_parts(self):
-            return len(self.parts) - 1
-
-        def num_running(self):
-            return len([p for p in self.parts[1:] if p['status'] == 'RUNNING'])
-
-        def num_downloaded(self):
-            return len([p for p in self.parts[1:]
-                       if p['status'] in ['DOWNLOADED','WRITTEN']])
-
-        def num_written(self):
-            return len([p for p in self.parts[1:] if p['status'] == 'WRITTEN'])
-
-        def num_failed(self):
-            return len([p for p in self.parts[1:] if p['status'] == 'FAILED'])
-
-        def download_part(self, part_num):
-            ''' Download a specific part of the S3 object '''
+        self.s3 = s3
+        self.bucket = bucket
+        self.s3_key = s3_key
+        self.fout = fout
+        self.num_s3_parts = num_s3_parts
+        self.part_size = part_size
+        self.ranges = ranges
+        self.etag = etag.strip('"') if etag else None
+        # A multipart ETag is the MD5 of the MD5s of the upload parts, a
+        # single part ETag is the MD5 of the whole object
+        self.part_md5 = bool(self.etag and '-' in self.etag and not ranges)
+        self.md5 = hashlib.md5() if self.etag and '-' not in self.etag \
+            else None
+        self.retries = max(1, retries)
+        self.max_buffered = num_s3_parts
+        if part_size and max_buffer_bytes:
+            self.max_buffered = max(1, int(max_buffer_bytes // part_size))
+        self.max_running = max(1, min(threads, self.max_buffered))
+        logging.info("S3 object parts: %d" % self.num_s3_parts)
+        logging.info("Max running threads: %d" % self.max_running)
+        logging.info("Max buffered parts: %d" % self.max_buffered)
+        self.parts = ['0-index not used']  # S3 part numbers are 1-relative
+        self.status_counts = Counter()
+        self.status_lock = threading.Lock()
+        self.total_size_read = 0
+        self.total_read_secs = 0
+        self.max_read_secs = 0
+
+    def num_parts(self):
+        return len(self.parts) - 1
+
+    def num_running(self):
+        return self.status_counts['RUNNING']
+
+    def num_downloaded(self):
+        return (self.status_counts['DOWNLOADED'] +
+                self.status_counts['WRITTEN'])
+
+    def num_written(self):
+        return self.status_counts['WRITTEN']
+
+    def num_failed(self):
+        return self.status_counts['FAILED']
+
+    def add_part(self, status):
+        ''' Start tracking the next part '''
+        with self.status_lock:
+            self.parts.append({'time': 0,
+                               'data': None,
+                               'status': status})
+            self.status_counts[status] += 1
+        return len(self.parts) - 1
+
+    def set_status(self, part_num, status):
+        ''' Move a part to a new status, keeping the counters in step '''
+        part = self.parts[part_num]
+        with self.status_lock:
+            self.status_counts[part['status']] -= 1
+            self.status_counts[status] += 1
+            part['status'] = status
+
+    def read_part(self, part_num):
+        ''' Read a specific part of the S3 object '''
+        if self.ranges:
+            start = (part_num - 1) * self.part_size
+            byte_range = "bytes=%d-%d" % (start, start + self.part_size - 1)
+            part = self.s3.get_object(Bucket=self.bucket, Key=self.s3_key,
+                                      Range=byte_range)
+        else:
+            part = self.s3.get_object(Bucket=self.bucket, Key=self.s3_key,
+                                      PartNumber=part_num)
+        data = part['Body'].read()
+        if len(data) != part['ContentLength']:
+            logging.error("Expected %d bytes, got %d!" %
+                          (part['ContentLength'], len(data)))
+            raise ReadException
+        return data
+
+    def download_part(self, part_num):
+        ''' Download a specific part of the S3 object, retrying it on
+            failure.
+        '''
+        for attempt in range(1, self.retries + 1):
             try:
-                logging.debug("Starting thread %d" % part_num)
-                part = s3.get_object(Bucket=args.bucket, Key=args.s3_key,
-                                     PartNumber=part_num)
+                logging.debug("Starting part %d, attempt %d" %
+                              (part_num, attempt))
                 before_read = current_ts()
-
-                data = part['Body'].read()
+                data = self.read_part(part_num)
                 self.parts[part_num]['time'] = current_ts() - before_read
-                if len(data) != part['ContentLength']:
-                    logging.error("Expected %d bytes, got %d!" %
-                                  (len(data), part['ContentLength']))
-                    raise ReadException
+                if self.part_md5:
+                    self.parts[part_num]['md5'] = hashlib.md5(data).digest()
                 self.parts[part_num]['data'] = data
-                self.parts[part_num]['status'] = 'DOWNLOADED'
-                logging.debug("Ending thread %d, size %d" %
+                self.set_status(part_num, 'DOWNLOADED')
+                logging.debug("Ending part %d, size %d" %
                               (part_num, len(data)))
-            except Exception as e:
-                self.parts[part_num]['status'] = 'FAILED'
-                logging.error("Thread %d failed" % part_num)
-                traceback.print_exc()
-
-        def start_thread(self):
-            ''' Start a new thread to download a part of the S3 object '''
-            part_num = len(self.parts)
-            new_thread = threading.Thread(name="Thread"+str(part_num),
-                                          target=self.download_part,
-                                          args=(part_num,))
-            self.parts.append({'thread':new_thread,
-                               'time':0,
-                               'data':None,
-                               'status':'RUNNING'})
-            new_thread.start()
-
-        def write_part(self, part_num):
-            ''' Write the part to the file.  All parts must be written in
-                order.
-            '''
+                return
+            except Exception:
+                logging.warning("Part %d failed on attempt %d" %
+                                (part_num, attempt), exc_info=True)
+                if attempt < self.retries:
+                    t.sleep(RETRY_BACKOFF_SECS * 2 ** (attempt - 1))
+        self.set_status(part_num, 'FAILED')
+        logging.error("Part %d failed" % part_num)
+
+    def start_thread(self, executor):
+        ''' Submit the download of the next part of the S3 object '''
+        part_num = self.add_part('RUNNING')
+        return executor.submit(self.download_part, part_num)
+
+    def skip_thread(self):
+        ''' Record the next part as already written '''
+        self.add_part('WRITTEN')
+
+    def is_written(self, part_num):
+        ''' Whether a part was written by a previous run '''
+        return False
+
+    def write_part(self, part_num):
+        ''' Write the part to the file.  All parts must be written in
+            order.
+        '''
+        part = self.parts[part_num]
+        self.fout.write(part['data'])
+        if self.md5 is not None:
+            self.md5.update(part['data'])
+
+    def collect_thread(self):
+        ''' Collect each thread write the file part, in order.  The part
+            data is released as soon as it is written.
+        '''
+        part_num = self.num_written()+1
+        if (self.num_parts() >= part_num and
+                self.parts[part_num]['status'] == 'DOWNLOADED'):
             part = self.parts[part_num]
+            logging.debug("Downloaded part %d in %d seconds" % (
+                          part_num, part['time']))
+            self.max_read_secs = (
+                part['time'] if part['time'] > self.max_read_secs
+                else self.max_read_secs)
+            self.total_read_secs += part['time']
+            self.total_size_read += len(part['data'])
+            self.write_part(part_num)
+            part['data'] = None
+            self.set_status(part_num, 'WRITTEN')
+            return True
+        else:
+            return False
 
-        def collect_thread(self):
-            ''' Collect each thread write the file part, in order.
-                Garbage collect
-                to prevent large amount of memory usage when the file is large.
-            '''
-            part_num = self.num_written()+1
-            if (self.num_parts() >= part_num and
-                self.parts[part_num]['status'] == 'DOWNLOADED'
-               ):
-                part = self.parts[part_num]
-                logging.debug("Downloaded part %d in %d seconds" % (
-                              part_num, part['time']))
-                self.max_read_secs = (
-                    part['time'] if part['time'] > self.max_read_secs
-                    else self.max_read_secs)
-                self.total_read_secs += part['time']
-                self.total_size_read += len(part['data'])
-                self.write_part(part_num)
-                part['status'] = 'WRITTEN'
-                part['data'] = None
-                gc.collect()  # Clean-up unreferenced data.
-                return True
-            else:
-                return False
-
-            # Loop until any child thread fails or all parts have been written.
+    def verify(self):
+        ''' Compare the object ETag with the digests of the parts that were
+            written.  Returns None when the ETag can't be checked this way.
+        '''
+        if self.part_md5:
+            digests = [p.get('md5') for p in self.parts[1:]]
+            if None in digests:
+                return None
+            digest = "%s-%d" % (hashlib.md5(b"".join(digests)).hexdigest(),
+                                len(digests))
+        elif self.md5 is not None:
+            digest = self.md5.hexdigest()
+        else:
+            return None
+        if digest != self.etag:
+            logging.error("ETag mismatch: expected %s, got %s" %
+                          (self.etag, digest))
+            return False
+        logging.info("ETag verified: %s" % digest)
+        return True
+
+    def download(self):
+        ''' Download all the parts and write them in order.  Returns the
+            number of parts that failed.
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_running) as executor:
+            running = set()
+            # Loop until any part fails or all parts have been written.
             while (self.num_failed() == 0 and
                    self.num_written() < self.num_s3_parts):
-                # Start a new thread if...
+                # Start new downloads as long as...
                 #  1) We're running fewer than the max allowed
                 #  2) There are still more parts to process
-                if (self.num_running() < self.max_running and
-                    self.num_parts() < self.num_s3_parts
-                   ):
-                    self.start_thread()
-                    if self.num_written() < self.num_downloaded() - 300:
-                        self.collect_thread()
-                elif not self.collect_thread():
-                    # Sleep if a thread was not started nor collected.
-                    t.sleep(5)
+                #  3) The reorder buffer has room for another part
+                while (len(running) < self.max_running and
+                       self.num_parts() < self.num_s3_parts and
+                       self.num_parts() - self.num_written() <
+                       self.max_buffered):
+                    if self.is_written(self.num_parts() + 1):
+                        self.skip_thread()
+                    else:
+                        running.add(self.start_thread(executor))
+
+                # Wait for any download to finish
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                while self.collect_thread():
+                    pass
                 logging.info("parts: total %d, started %d, running %d, "
                              "downloaded %d, written %d" %
                              (self.num_s3_parts, self.num_parts(),
                               self.num_running(), self.num_downloaded(),
                               self.num_written()))
 
-            fout.close()
-            if self.num_failed() == 0:
-                logging.info("All parts downloaded: total_size_read %d, "
-                    "max_read_secs %d, avg_read_secs %d" % (
-                    self.total_size_read, self.max_read_secs,
-                    int(self.total_read_secs/self.num_s3_parts)))
-            else:
-                if args.file:
-                    os.unlink(args.file)
-            return self.num_failed()
+        if self.num_failed() == 0:
+            logging.info("All parts downloaded: total_size_read %d, "
+                         "max_read_secs %d, avg_read_secs %d" % (
+                             self.total_size_read, self.max_read_secs,
+                             int(self.total_read_secs /
+                                 max(1, self.num_s3_parts))))
+        return self.num_failed()
+
+
+class PositionalParts(Parts):
+    ''' Download an S3 object in parts and write each of them at its
+        offset of a preallocated file as soon as it is downloaded.  Written
+        parts are appended to a checkpoint file, parts found in it are not
+        downloaded again.
+    '''
+    def __init__(self, s3, bucket, s3_key, num_s3_parts, fd, part_size,
+                 checkpoint_file, threads=DEFAULT_THREADS,
+                 retries=DEFAULT_RETRIES, completed=None, ranges=False,
+                 etag=None):
+        super(PositionalParts, self).__init__(
+            s3, bucket, s3_key, num_s3_parts, None, part_size=part_size,
+            threads=threads, max_buffer_bytes=None, retries=retries,
+            ranges=ranges, etag=etag)
+        # Parts are written out of order and some by a previous run, the
+        # whole object MD5 is computed from the file once it is complete
+        self.md5 = None
+        self.fd = fd
+        self.checkpoint_file = checkpoint_file
+        self.completed = set(completed or [])
+        self.lock = threading.Lock()
+        if self.completed:
+            logging.info("Resuming, %d parts already written" %
+                         len(self.completed))
+
+    def is_written(self, part_num):
+        return part_num in self.completed
+
+    def collect_thread(self):
+        ''' Parts are written by the threads that download them '''
+        return False
+
+    def download_part(self, part_num):
+        super(PositionalParts, self).download_part(part_num)
+        if self.parts[part_num]['status'] == 'DOWNLOADED':
+            try:
+                self.write_part(part_num)
+            except Exception:
+                self.set_status(part_num, 'FAILED')
+                logging.error("Writing part %d failed" % part_num,
+                              exc_info=True)
+
+    def verify(self):
+        ''' Compare the object ETag with the MD5 of the written file.  A
+            multipart ETag can't be checked: it depends on the sizes of the
+            upload parts, not those of the byte ranges.  Returns None when
+            the ETag can't be checked.
+        '''
+        if not self.etag:
+            return None
+        if '-' in self.etag:
+            logging.warning("s3://%s/%s was uploaded in parts, the resumable "
+                            "download can't be verified against its ETag %s" %
+                            (self.bucket, self.s3_key, self.etag))
+            return None
+        md5 = hashlib.md5()
+        offset = 0
+        while True:
+            data = os.pread(self.fd, VERIFY_BLOCK_BYTES, offset)
+            if not data:
+                break
+            md5.update(data)
+            offset += len(data)
+        self.md5 = md5
+        return super(PositionalParts, self).verify()
+
+    def write_part(self, part_num):
+        ''' Write the part at its offset and record it in the checkpoint
+        '''
+        part = self.parts[part_num]
+        data = part['data']
+        offset = (part_num - 1) * self.part_size
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+        with self.lock:
+            self.max_read_secs = max(self.max_read_secs, part['time'])
+            self.total_read_secs += part['time']
+            self.total_size_read += len(data)
+            self.checkpoint_file.write("%d\n" % part_num)
+            self.checkpoint_file.flush()
+            part['data'] = None
+        self.set_status(part_num, 'WRITTEN')
+
+
+def read_checkpoint(path, etag, part_size=None):
+    ''' Read the parts written by a previous run of the same object
+        version, split the same way.  Returns an empty set when there is
+        nothing to resume.
+    '''
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        lines = f.read().splitlines()
+    header = json.loads(lines[0]) if lines else {}
+    if (header.get('ETag') != etag or
+            header.get('part_size', part_size) != part_size):
+        logging.info("Checkpoint %s is for another object version" % path)
+        return set()
+    # A run killed mid-line leaves a partial last line, ignore it
+    return set(int(line) for line in lines[1:] if line.isdigit())
+
+
+def plan_parts(s3, bucket, s3_key, range_size=None):
+    ''' Work out how to split an S3 object.  Objects uploaded in one part
+        are split in byte ranges even if range_size is not given.  Returns
+        the object info, the number of parts, their size and whether they
+        are byte ranges.
+    '''
+    logging.info("Getting object metadata from s3://%s/%s" %
+                 (bucket, s3_key))
+    s3_object = s3.head_object(Bucket=bucket, Key=s3_key)
+    size = s3_object['ContentLength']
+    if size == 0:
+        # Any range of an empty object is answered with 416
+        logging.info("Empty object, nothing to download")
+        return s3_object, 0, range_size or DEFAULT_RANGE_MB * 1024 * 1024, True
+    if not range_size:
+        # Part 1 tells how many parts there are
+        first_part = s3.head_object(Bucket=bucket, Key=s3_key, PartNumber=1)
+        if 'PartsCount' in first_part:
+            return (s3_object, int(first_part['PartsCount']),
+                    first_part['ContentLength'], False)
+        range_size = DEFAULT_RANGE_MB * 1024 * 1024
+    num_ranges = max(1, (size + range_size - 1) // range_size)
+    logging.info("Downloading %d byte ranges of %d bytes" %
+                 (num_ranges, range_size))
+    return s3_object, num_ranges, range_size, True
+
+
+def verifiable_etag(s3_object):
+    ''' The ETag of the object, unless it is not an MD5 digest (SSE-KMS
+        and SSE-C)
+    '''
+    if (s3_object.get('ServerSideEncryption') == 'aws:kms' or
+            'SSECustomerAlgorithm' in s3_object):
+        return None
+    return s3_object.get('ETag')
+
+
+def fetch_resumable(s3, bucket, s3_key, path, threads=DEFAULT_THREADS,
+                    retries=DEFAULT_RETRIES, range_size=None):
+    ''' Download an S3 object into a preallocated file, writing every part
+        at its offset.  The checkpoint is removed once the download is
+        complete.  Returns the number of parts that failed and the object
+        metadata.  The object is always split in byte ranges: the parts of
+        a multipart upload can have any size, their offsets are not known
+        before they are all downloaded.
+    '''
+    s3_object, num_s3_parts, part_size, ranges = plan_parts(
+        s3, bucket, s3_key, range_size or DEFAULT_RANGE_MB * 1024 * 1024)
+    size = s3_object['ContentLength']
+    etag = s3_object.get('ETag')
+
+    checkpoint_path = path + '.parts'
+    completed = read_checkpoint(checkpoint_path, etag, part_size)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if completed and os.fstat(fd).st_size != size:
+            # The parts of the checkpoint are not in the file any more
+            logging.info("%s is not the file of checkpoint %s, starting over" %
+                         (path, checkpoint_path))
+            completed = set()
+        if not completed:
+            with open(checkpoint_path, 'w') as cf:
+                cf.write(json.dumps({'ETag': etag, 'size': size,
+                                     'part_size': part_size}) + "\n")
+            os.ftruncate(fd, 0)
+        # Preallocate the file so every part can be written at its offset
+        if hasattr(os, 'posix_fallocate') and size:
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+
+        logging.info("Downloading parts of data from s3://%s/%s..." %
+                     (bucket, s3_key))
+        with open(checkpoint_path, 'a') as checkpoint_file:
+            parts = PositionalParts(s3, bucket, s3_key, num_s3_parts, fd,
+                                    part_size, checkpoint_file,
+                                    threads=threads, retries=retries,
+                                    completed=completed, ranges=ranges,
+                                    etag=verifiable_etag(s3_object))
+            failed = parts.download()
+        verified = None if failed else parts.verify()
+    finally:
+        os.close(fd)
+
+    if not failed:
+        # A file that doesn't match the ETag is downloaded again from scratch
+        os.unlink(checkpoint_path)
+        if verified is False:
+            failed = 1
+    return failed, s3_object.get('Metadata')
+
+
+def fetch(s3, bucket, s3_key, fout, threads=DEFAULT_THREADS,
+          max_buffer_bytes=DEFAULT_MAX_BUFFER_MB * 1024 * 1024,
+          retries=DEFAULT_RETRIES, range_size=None, stats=None):
+    ''' Download an S3 object into an open file.  Returns the number of
+        parts that failed and the object metadata.  A download that doesn't
+        match the object ETag counts as one failed part.  The part stats are
+        added to the stats dict when one is given.
+    '''
+    s3_object, num_s3_parts, part_size, ranges = plan_parts(
+        s3, bucket, s3_key, range_size)
+
+    # Initiate the process to download the S3 object.
+    logging.info("Downloading parts of data from s3://%s/%s..." %
+                 (bucket, s3_key))
+    parts = Parts(s3, bucket, s3_key, num_s3_parts, fout,
+                  part_size=part_size, threads=threads,
+                  max_buffer_bytes=max_buffer_bytes, retries=retries,
+                  ranges=ranges, etag=verifiable_etag(s3_object))
+    failed = parts.download()
+    if not failed and parts.verify() is False:
+        failed = 1
+    if stats is not None:
+        stats.update(parts=num_s3_parts, failed_parts=failed,
+                     total_size_read=parts.total_size_read,
+                     max_read_secs=parts.max_read_secs,
+                     total_read_secs=parts.total_read_secs)
+    return failed, s3_object.get('Metadata')
+
+
+class StreamWriter(object):
+    ''' File-like object decompressing what is written to it before
+        passing it on.  Concatenated gzip members and bz2 streams are
+        supported.
+    '''
+    def __init__(self, fout, compression=None):
+        self.fout = fout
+        self.compression = compression
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decompressor = self.new_decompressor()
+
+    def new_decompressor(self):
+        if self.compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.compression == 'bz2':
+            return bz2.BZ2Decompressor()
+        return None
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        if self.decompressor is None:
+            self.fout.write(data)
+            self.bytes_out += len(data)
+            return
+        while data:
+            out = self.decompressor.decompress(data)
+            self.fout.write(out)
+            self.bytes_out += len(out)
+            data = b""
+            if self.decompressor.eof:
+                # The next stream starts right after this one
+                data = self.decompressor.unused_data
+                self.decompressor = self.new_decompressor()
+
+    def flush(self):
+        self.fout.flush()
 
+
+def detect_compression(s3_key, compression='auto'):
+    ''' Resolve the compression of an object, guessing it from the key
+        extension when compression is auto.
+    '''
+    if compression == 'auto':
+        return COMPRESSIONS.get(os.path.splitext(s3_key)[1].lower())
+    return None if compression == 'none' else compression
+
+
+def stream_to_fifo(fifo_path, s3, bucket, s3_key, compression, result,
+                   **kwargs):
+    ''' Download an S3 object into a named pipe, decompressing it.  The
+        outcome is stored in result since this runs in its own thread.
+    '''
+    try:
+        with open(fifo_path, 'wb') as fifo:
+            writer = StreamWriter(fifo, compression)
+            result['failed'], _ = fetch(s3, bucket, s3_key, writer,
+                                        stats=result['stats'], **kwargs)
+            result['bytes'] = writer.bytes_in
+    except Exception as e:
+        logging.error("Streaming s3://%s/%s failed" % (bucket, s3_key),
+                      exc_info=True)
+        result['error'] = e
+
+
+def run(config, pool, table, bucket, key, profile=None, compression='auto',
+        header=True, threads=DEFAULT_THREADS, load_path=None):
+    ''' Stream an S3 object into a vertica table.  The parts are written to
+        a named pipe that COPY ... FROM LOCAL reads from, so the download
+        and the load overlap and nothing is staged on disk.  Returns a
+        summary of the run.
+    '''
+    s3_settings = config.get('s3', {})
+    if load_path is None:
+        load_path = os.path.join(config['data_dir'], 's3', table)
+    if not os.path.exists(load_path):
+        os.makedirs(load_path)
+    reject_file = os.path.join(load_path, "rejects")
+    exception_file = os.path.join(load_path, "exceptions")
+
+    session = boto3.Session(profile_name=profile or s3_settings.get('profile'))
+    s3 = session.client('s3', config=Config(signature_version='s3v4',
+                                            read_timeout=300))
+
+    fifo_path = os.path.join(load_path, "stream")
+    if os.path.exists(fifo_path):
+        os.unlink(fifo_path)
+    os.mkfifo(fifo_path)
+
+    result = {'failed': 0, 'error': None, 'bytes': None, 'stats': {}}
+    max_buffer_mb = s3_settings.get('max_buffer_mb', DEFAULT_MAX_BUFFER_MB)
+    writer = threading.Thread(
+        name="s3-stream", target=stream_to_fifo,
+        args=(fifo_path, s3, bucket, key, detect_compression(key, compression),
+              result),
+        kwargs=dict(threads=threads,
+                    max_buffer_bytes=max_buffer_mb * 1024 * 1024))
+
+    def check_download():
+        # COPY can't tell a complete stream from an interrupted one
+        writer.join()
+        if result['error'] is not None or result['failed']:
+            raise ReadException("Download of s3://%s/%s failed, not committing"
+                                % (bucket, key))
+
+    with RunMetrics('s3', table) as run_metrics:
+        started = current_ts()
+        writer.start()
+        try:
+            swap = config['vertica'].get('swap', False)
+            # The download and the load overlap, they are a single stage
+            with run_metrics.stage('load') as stage, pool.cursor() as cursor:
+                stage['rows'] = load(cursor, table, fifo_path, reject_file,
+                                     exception_file, swap=swap,
+                                     skip=1 if header else 0,
+                                     before_commit=check_download)
+        finally:
+            while writer.is_alive():
+                # The load failed before reading the pipe, open and close it
+                # so the writer gets a broken pipe instead of blocking forever
+                fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+                writer.join(0.1)
+                os.close(fd)
+            os.unlink(fifo_path)
+            run_metrics.record('fetch', bytes=result['bytes'],
+                               **result['stats'])
+
+        return {
+            'rows': stage['rows'],
+            'bytes': result['bytes'],
+            'fetch_secs': None,
+            'load_secs': current_ts() - started,
+        }
+
+
+@click.command('s3')
+@click.option("--table", type=str, required=True,
+              help="Name of the target table where the load should be persisted")
+@click.option("--bucket", type=str, required=True, help="S3 bucket")
+@click.option("--key", type=str, required=True, help="S3 key of the object to load")
+@click.option("--profile", type=str, default=None, help="AWS profile, defaults to s3.profile in the config")
+@click.option("--compression", type=click.Choice(['auto', 'gzip', 'bz2', 'none']), default='auto',
+              help="Compression of the object, guessed from the key extension by default")
+@click.option("--header/--no-header", default=True, help="Whether the first line is a header to skip")
+@click.option("--threads", type=int, default=DEFAULT_THREADS, help="Number of parts downloaded in parallel")
+@click.pass_context
+def s3_cmd(ctx, table, bucket, key, profile, compression, header, threads):
+    run(ctx.obj['config'], ctx.obj['pool'], table, bucket, key, profile, compression, header, threads)
+
+
+def main():
     # Get arguments
     aparser = argparse.ArgumentParser()
     aparser.add_argument("-p", "--profile", required=True, help="AWS profile")
     aparser.add_argument("-f", "--file", required=True,
-        help="name of file to be created with the S3 object")
+                         help="name of file to be created with the S3 object")
     aparser.add_argument("-b", "--bucket", required=True, help="S3 bucket")
     aparser.add_argument("-s", "--s3_key", required=True, help="S3 key")
     aparser.add_argument("-m", "--metadata_file",
-        help="name of local file to be created with S3 object metadata")
-    aparser.add_argument("-t", "--threads", type=int, default=5,
-        help="number of threads for parallel download")
+                         help="name of local file to be created with S3 "
+                              "object metadata")
+    aparser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                         help="number of threads for parallel download")
+    aparser.add_argument("-x", "--max_buffer_mb", type=int,
+                         default=DEFAULT_MAX_BUFFER_MB,
+                         help="limit on the MB downloading or waiting to be "
+                              "written")
+    aparser.add_argument("-r", "--retries", type=int, default=DEFAULT_RETRIES,
+                         help="attempts per part before giving up")
+    aparser.add_argument("-c", "--range_mb", type=int, default=None,
+                         help="download byte ranges of this many MB")
+    aparser.add_argument("--resume", action="store_true",
+                         help="write parts at their offset and resume an "
+                              "interrupted download")
     aparser.add_argument("-d", "--debug_level", default="INFO",
-        help="debug level (default is INFO)")
+                         help="debug level (default is INFO)")
     args = aparser.parse_args()
 
     # Configure logging
@@ -193,41 +730,46 @@ def main():
     logging.Formatter.converter = t.gmtime
     logging.basicConfig(format=cformat, datefmt=cdatefmt, stream=sys.stdout,
                         level=args.debug_level)
-    #logging.getLogger("boto3").setLevel(logging.INFO)
-    #logging.getLogger("botocore").setLevel(logging.INFO)
-
-#    if not (os.environ.get('http_proxy') and os.environ.get('https_proxy')):
-#        logging.error("http_proxy and https_proxy must be set")
-#        sys.exit(1)
 
     logging.info("profile: %s", args.profile)
     logging.info("file: %s", args.file)
     logging.info("bucket: %s", args.bucket)
     logging.info("s3_key: %s", args.s3_key)
     logging.info("metadata_file: %s", args.metadata_file)
-    args.threads = min(10, args.threads)   # max 10 threads
     logging.info("threads: %d", args.threads)
+    logging.info("max_buffer_mb: %d", args.max_buffer_mb)
+    range_size = args.range_mb * 1024 * 1024 if args.range_mb else None
 
     # Create AWS session for the given profile.
     session = boto3.Session(profile_name=args.profile)
     s3 = session.client('s3', config=Config(signature_version='s3v4',
                                             read_timeout=300))
 
-    # Get object info from S3.
-    logging.info("Getting object metadata from s3://%s/%s" %
-                 (args.bucket, args.s3_key))
-    s3_object = s3.get_object(Bucket=args.bucket, Key=args.s3_key)
-    ##                          PartNumber=1)
+    if args.resume:
+        # Keep the partial file and its checkpoint around to resume later
+        failed, metadata = fetch_resumable(s3, args.bucket, args.s3_key,
+                                           args.file, threads=args.threads,
+                                           retries=args.retries,
+                                           range_size=range_size)
+        if failed:
+            sys.exit(1)
+    else:
+        with open(args.file, "wb") as fout:
+            failed, metadata = fetch(s3, args.bucket, args.s3_key, fout,
+                                     threads=args.threads,
+                                     max_buffer_bytes=args.max_buffer_mb *
+                                     1024 * 1024,
+                                     retries=args.retries,
+                                     range_size=range_size)
+        if failed:
+            os.unlink(args.file)
+            sys.exit(1)
 
-    # Initiate the process to download the S3 object.
-    logging.info("Downloading parts of data from s3://%s/%s..." %
-                 (args.bucket, args.s3_key))
-    fout = open(args.file, "wb")
-    parts = Parts()
     if metadata and args.metadata_file:
         logging.info("Writing metadata to %s" % args.metadata_file)
         with open(args.metadata_file, "w") as mf:
             mf.write(json.dumps(metadata))
 
+
 if __name__ == '__main__':
     main()
@@ -8,15 +8,22 @@ setup(
     description='Python tool for collecting data and loading it into vertica',
     url='https://github.com/mozilla-it/data-collectors',
     packages=['collectors'],
-    data_files = [('collectors/defaults',['collectors/defaults/default_log_config.yml'])],
+    package_data={'collectors': ['defaults/*.yml']},
     python_requires='>=3.4',
     license='MPL-2.0',
     install_requires=[
-        'Click',
+        'Click>=7.0',
         'pyyaml',
-        'pandas',
-        'pyodbc'
+        # Nullable Int64 columns, categorical concat and groupby(observed=True)
+        'pandas>=1.1',
+        'pyodbc',
+        'boto3',
+        'requests'
     ],
+    extras_require={
+        # DataFrame.to_orc appeared in pandas 1.5
+        'columnar': ['pyarrow', 'pandas>=1.5'],
+    },
     tests_require=['pytest', 'pytest-cov', 'pytest-flake8'],
     setup_requires=['pytest-runner'],
     entry_points='''
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from tests.benchmarks import fakes
+
+# Multiplies the size of the synthetic data
+SCALE = float(os.environ.get('BENCHMARK_SCALE', 1))
+APPS = max(1, int(20 * SCALE))
+REDASH_ROWS = max(1, int(50000 * SCALE))
+
+
+@pytest.fixture(scope='module')
+def adjust_server():
+    """
+    adjust.com stand-in serving 5 years of daily activity for each of APPS apps at /<app key>.csv
+    """
+    routes = {"/app{}.csv".format(i): fakes.adjust_csv(seed=i) for i in range(APPS)}
+    with fakes.FakeHTTPServer(routes) as server:
+        yield server
+
+
+@pytest.fixture(scope='module')
+def redash_server():
+    """
+    redash stand-in serving a wide result at /results.csv
+    """
+    with fakes.FakeHTTPServer({'/results.csv': fakes.redash_csv(REDASH_ROWS)}) as server:
+        yield server
@@ -0,0 +1,148 @@
+"""
+Synthetic data and local stand-ins for the services the collectors talk to: an HTTP server for adjust.com and
+redash, an S3 bucket and a vertica cursor
+"""
+import datetime
+import hashlib
+import http.server
+import io
+import random
+import threading
+
+OSES = ['android', 'ios']
+
+
+def adjust_csv(years=5, oses=OSES, seed=0) -> bytes:
+    """
+    Daily activity of one app in the adjust.com CSV layout, one row per day and os
+    """
+    rng = random.Random(seed)
+    start = datetime.date(2015, 1, 1)
+    lines = ["date,os_name,daus,waus,maus,installs"]
+    for day in range(365 * years):
+        date = (start + datetime.timedelta(days=day)).isoformat()
+        for os_name in oses:
+            daus = rng.randint(1000, 100000)
+            installs = "" if rng.random() < 0.01 else str(rng.randint(0, 5000))
+            lines.append("{},{},{},{},{},{}".format(date, os_name, daus, daus * 3, daus * 9, installs))
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def redash_csv(rows=200000, columns=20, seed=0) -> bytes:
+    """
+    Wide redash result mixing dates, low cardinality strings, integers and floats
+    """
+    rng = random.Random(seed)
+    header = ["day", "channel"] + ["metric_{}".format(i) for i in range(columns - 2)]
+    channels = ['release', 'beta', 'nightly', 'esr']
+    lines = [",".join(header)]
+    for row in range(rows):
+        values = ["2018-{:02d}-{:02d}".format(row % 12 + 1, row % 28 + 1), channels[row % len(channels)]]
+        values += [str(rng.randint(0, 10 ** 6)) if i % 2 else "{:.4f}".format(rng.random())
+                   for i in range(columns - 2)]
+        lines.append(",".join(values))
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+class StaticHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the bodies of server.routes by path, keeping connections alive
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.server.routes.get(self.path.split('?')[0])
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeHTTPServer(object):
+    """
+    Local HTTP server running in a background thread::
+
+        with FakeHTTPServer({'/results.csv': body}) as server:
+            server.url('/results.csv')
+    """
+    def __init__(self, routes):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StaticHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.routes = routes
+
+    def url(self, path) -> str:
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_port, path)
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeS3(object):
+    """
+    In-memory S3 client holding objects uploaded in parts of part_size bytes, answering the head_object and
+    get_object calls made by s3_fetcher
+    """
+    def __init__(self, part_size=8 * 1024 * 1024):
+        self.part_size = part_size
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def _parts(self, data):
+        return [(start, min(start + self.part_size, len(data))) for start in range(0, len(data), self.part_size)]
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        data = self.objects[(Bucket, Key)]
+        parts = self._parts(data)
+        digests = b"".join(hashlib.md5(data[start:end]).digest() for start, end in parts)
+        head = {'ContentLength': len(data), 'Metadata': {},
+                'ETag': '"{}-{}"'.format(hashlib.md5(digests).hexdigest(), len(parts))}
+        if PartNumber is not None:
+            start, end = parts[PartNumber - 1]
+            head.update(ContentLength=end - start, PartsCount=len(parts))
+        return head
+
+    def get_object(self, Bucket, Key, PartNumber=None, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = [int(b) for b in Range[len("bytes="):].split('-')]
+            end = min(end + 1, len(data))
+        else:
+            start, end = self._parts(data)[PartNumber - 1]
+        return {'Body': io.BytesIO(data[start:end]), 'ContentLength': end - start}
+
+
+class RecordingCursor(object):
+    """
+    pyodbc cursor recording the statements it executes.  COPY ... FROM LOCAL reads its files like the vertica
+    client would and reports their lines (less the header) as the row count.
+    """
+    def __init__(self):
+        self.statements = []
+        self.rowcount = -1
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        if statement.startswith("COPY") and " FROM LOCAL " in statement:
+            sources = statement.split(" FROM LOCAL ")[1].split(" DELIMITER ")[0]
+            self.rowcount = 0
+            for path in sources.split("', '"):
+                with open(path.strip("'"), 'rb') as f:
+                    self.rowcount += sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b"")) - 1
+        return self
+
+    def fetchone(self):
+        return None
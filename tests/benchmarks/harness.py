@@ -0,0 +1,78 @@
+"""
+Measure the wall time and memory of a benchmark and compare them with the baselines saved on this machine.
+
+Benchmarks only run with BENCHMARKS=1.  Wall times only compare on the same machine, so the baselines are not part of
+the repository: the first run of a benchmark records its baseline in baselines.json (ignored by git), and
+BENCHMARKS_SAVE=1 records the results as the new baselines instead of comparing with them.  BENCHMARK_TOLERANCE sets
+how much slower or bigger than its baseline a result may be.
+"""
+import json
+import os
+import time
+import tracemalloc
+
+import pytest
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 1.5))
+# Differences below these are noise whatever the ratio
+NOISE = {'secs': 0.05, 'peak_bytes': 1024 * 1024}
+
+
+def measure(fn, repeat=3) -> dict:
+    """
+    Best wall time of `repeat` runs, then one more run traced for the peak of memory allocated by Python and numpy
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'secs': min(timings), 'peak_bytes': peak}
+
+
+def read_baselines() -> dict:
+    try:
+        with open(BASELINES) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def check(name, result, rows=None, nbytes=None) -> dict:
+    """
+    Report a benchmark result and save it as a baseline or fail when it regressed against the saved one
+    :param name: name of the benchmark
+    :param result: measure() result
+    :param rows: rows processed by one run, to report the throughput
+    :param nbytes: bytes processed by one run, to report the throughput
+    :return: the result with its throughput
+    """
+    result = dict(result)
+    if rows:
+        result['rows_per_sec'] = rows / result['secs']
+    if nbytes:
+        result['mb_per_sec'] = nbytes / 1024 / 1024 / result['secs']
+    print("{}: {}".format(name, ", ".join("{}={:.3f}".format(k, v) for k, v in sorted(result.items()))))
+
+    baselines = read_baselines()
+    baseline = baselines.get(name)
+    if baseline is None or os.environ.get('BENCHMARKS_SAVE'):
+        baselines[name] = result
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return result
+
+    for metric in ('secs', 'peak_bytes'):
+        if result[metric] > baseline[metric] * TOLERANCE and result[metric] - baseline[metric] > NOISE[metric]:
+            pytest.fail("{} regressed: {} is {:.3f} against a baseline of {:.3f}".format(
+                name, metric, result[metric], baseline[metric]))
+    return result
@@ -0,0 +1,85 @@
+import io
+import os
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+
+from collectors import adjust, redash, s3_fetcher
+from collectors.common import load, write_to_file
+from tests.benchmarks import fakes
+from tests.benchmarks.conftest import APPS, REDASH_ROWS, SCALE
+from tests.benchmarks.harness import check, measure
+
+pytestmark = pytest.mark.skipif(not os.environ.get('BENCHMARKS'), reason="benchmarks only run with BENCHMARKS=1")
+
+
+def served_job(server):
+    class ServedJob(adjust.DailyActiveUsers):
+        def build_url(self, app_key, token, **kwargs):
+            return server.url("/{}.csv".format(app_key))
+
+    return ServedJob
+
+
+@pytest.fixture
+def apps():
+    return OrderedDict(("app{}".format(i), "app{}".format(i)) for i in range(APPS))
+
+
+def test_write_apps(adjust_server, apps, tmpdir):
+    job = served_job(adjust_server)
+    paths = adjust.write_apps(apps, "token", job, str(tmpdir), workers=4)
+    rows = sum(len(pd.read_csv(path)) for path in paths)
+
+    result = measure(lambda: adjust.write_apps(apps, "token", job, str(tmpdir), workers=4))
+    check('adjust.write_apps', result, rows=rows, nbytes=sum(len(b) for b in adjust_server.httpd.routes.values()))
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_redash_collect(redash_server, tmpdir, stream):
+    url = redash_server.url('/results.csv')
+
+    result = measure(lambda: redash.collect(url, str(tmpdir), stream=stream))
+    check('redash.collect[stream={}]'.format(stream), result, rows=REDASH_ROWS,
+          nbytes=len(redash_server.httpd.routes['/results.csv']))
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'csv.gz', 'parquet'])
+def test_write_to_file(tmpdir, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    df = pd.read_csv(io.BytesIO(fakes.redash_csv(REDASH_ROWS)), parse_dates=['day'],
+                     dtype={'channel': 'category'})
+
+    result = measure(lambda: write_to_file(df, str(tmpdir), fmt=fmt))
+    check('common.write_to_file[{}]'.format(fmt), result, rows=len(df))
+
+
+def test_load(tmpdir):
+    paths = []
+    for i in range(4):
+        path = tmpdir.join("output_{}.csv".format(i))
+        path.write_binary(fakes.redash_csv(REDASH_ROWS // 4, seed=i))
+        paths.append(str(path))
+
+    cursor = fakes.RecordingCursor()
+    rows = load(cursor, 'foo', paths, 'rejects', 'exceptions')
+    assert rows == REDASH_ROWS // 4 * 4
+
+    result = measure(lambda: load(fakes.RecordingCursor(), 'foo', paths, 'rejects', 'exceptions'))
+    check('common.load', result, rows=rows, nbytes=sum(os.path.getsize(p) for p in paths))
+
+
+def test_part_download(tmpdir):
+    data = os.urandom(int(64 * 1024 * 1024 * SCALE))
+    s3 = fakes.FakeS3(part_size=8 * 1024 * 1024)
+    s3.put_object(Bucket='bucket', Key='key', Body=data)
+
+    def download():
+        with open(str(tmpdir.join('object')), 'wb') as fout:
+            failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', fout, threads=4)
+        assert failed == 0
+
+    result = measure(download)
+    check('s3_fetcher.fetch', result, nbytes=len(data))
@@ -1,6 +1,12 @@
+import datetime
+import os
+import time
+from collections import OrderedDict
 from io import StringIO
 from unittest import mock
 
+import click
+import pandas as pd
 import pytest
 
 import collectors.common
@@ -27,6 +33,17 @@ def test_colllect():
     print("Loaded successfully")
 
 
+def test_collect_schema():
+    data = test_data + "2017-01-03,ios,30,60,90,\n"
+
+    df = adjust.DailyActiveUsers().collect('foo', StringIO(data), chunksize=1)
+    assert str(df['adj_date'].dtype).startswith('datetime64')
+    assert df['os'].dtype == 'category'
+    assert df['app'].dtype == 'category'
+    assert list(df['installs']) == [1, 2, 0]
+    assert list(df['os'].cat.categories) == ['android', 'ios']
+
+
 def test_adjust_url_builder():
     job = adjust.DailyActiveUsers()
     url = job.build_url("abc", "123")
@@ -34,11 +51,264 @@ def test_adjust_url_builder():
     assert url.__contains__("https://api.adjust.com")
 
 
+class SlowJob(adjust.DailyActiveUsers):
+    """
+    Job that answers from memory, the first app being the slowest to respond
+    """
+    def build_url(self, app_key, token, **kwargs):
+        return app_key
+
+    def collect(self, app_name, url, chunksize=adjust.DEFAULT_CHUNKSIZE, content_hash=None):
+        time.sleep(0.2 if app_name == 'first' else 0)
+        if url == 'broken':
+            raise IOError("upstream failure")
+        return super().collect(app_name, StringIO(test_data))
+
+
+def test_write_apps_keeps_order(tmpdir):
+    apps = OrderedDict([('first', 'a'), ('second', 'b'), ('third', 'c')])
+    paths = adjust.write_apps(apps, "123", SlowJob, str(tmpdir), workers=3)
+    df = pd.concat(pd.read_csv(path) for path in paths)
+    assert list(df['app'].unique()) == ['first', 'second', 'third']
+    assert len(df) == 6
+
+
+def test_write_apps_failure(tmpdir):
+    apps = OrderedDict([('first', 'a'), ('second', 'broken'), ('third', 'c')])
+    with pytest.raises(IOError):
+        adjust.write_apps(apps, "123", SlowJob, str(tmpdir), workers=2)
+
+
+class MemoryJob(adjust.DailyActiveUsers):
+    """
+    Job that reads its CSV from memory instead of adjust.com
+    """
+    def build_url(self, app_key, token, **kwargs):
+        return StringIO(test_data)
+
+
+def test_stream_apps(tmpdir):
+    apps = OrderedDict([('first', 'a'), ('second', 'b')])
+    chunks = list(adjust.stream_apps(apps, "123", MemoryJob, chunksize=1))
+    assert len(chunks) == 4
+
+    output = collectors.common.stream_to_file(iter(chunks), str(tmpdir))
+    expected = pd.concat(adjust.collect_app(MemoryJob, app, key, "123") for app, key in apps.items())
+    with open(output) as f:
+        assert f.read() == expected.to_csv(index=False)
+
+
+def test_write_apps(tmpdir):
+    apps = OrderedDict([('first', 'a'), ('second app', 'b'), ('third', 'c')])
+    content_hash = collectors.common.ContentHash(str(tmpdir), 'foo')
+    paths = adjust.write_apps(apps, "123", SlowJob, str(tmpdir), workers=3, content_hash=content_hash)
+
+    assert [os.path.basename(p) for p in paths] == ['output_first.csv', 'output_second_app.csv', 'output_third.csv']
+    for path in paths:
+        assert pd.read_csv(path)['app'].nunique() == 1
+
+    # The digest doesn't depend on which app arrived first
+    again = collectors.common.ContentHash(str(tmpdir), 'foo')
+    adjust.write_apps(apps, "123", SlowJob, str(tmpdir), workers=1, content_hash=again)
+    assert again.hexdigest() == content_hash.hexdigest()
+
+
+retention_data = """adj_date,os,period,retention_rate
+2018-01-01,ios,0,1.0
+2018-01-01,ios,1,0.5
+2018-01-02,ios,1,0.3
+2018-01-02,android,1,0.2
+2018-01-08,ios,1,0.1
+2018-02-01,ios,1,0.4
+"""
+
+
+def test_retention_rollup():
+    job = adjust.Retention()
+    df = job.collect('foo', StringIO(retention_data))
+
+    weekly = job.rollup(df, 'weekly')
+    assert list(weekly.columns) == ['adj_date', 'os', 'app', 'period', 'retention_rate', 'cohorts']
+    first = weekly[(weekly['adj_date'] == '2018-01-01') & (weekly['os'] == 'ios') & (weekly['period'] == 1)]
+    assert first['retention_rate'].tolist() == [pytest.approx(0.4)]
+    assert first['cohorts'].tolist() == [2]
+    assert len(weekly) == 5
+
+    monthly = job.rollup(df, 'monthly')
+    assert sorted(monthly['adj_date'].dt.strftime('%Y-%m-%d').unique()) == ['2018-01-01', '2018-02-01']
+    assert monthly['cohorts'].sum() == len(df)
+
+
+def test_rollup_start():
+    # Wednesday 2018-03-14 is in the week of 2018-03-12 and the month of 2018-03-01
+    assert adjust.rollup_start("2018-03-14", ['W']) == "2018-03-12"
+    assert adjust.rollup_start("2018-03-14", ['W', 'M']) == "2018-03-01"
+    assert adjust.rollup_start("2018-03-14", []) == "2018-03-14"
+
+
+def test_unknown_rollup():
+    assert not hasattr(adjust.DailyActiveUsers, 'rollup')
+    with pytest.raises(click.BadParameter):
+        adjust.run({'adjust': {}}, None, 'foo', 'daily_active_users', rollups=['weekly'])
+
+
+def test_declare_job():
+    config = {'jobs': {'sessions': {'kpis': {'sessions': 'Int64'}, 'os_names': ['ios']}}}
+    job = adjust.get_job('sessions', config)
+    assert job.COLUMNS == ['adj_date', 'os', 'sessions']
+    assert job.DTYPES == {'os': 'category', 'sessions': 'Int64'}
+    url = job().build_url("abc", "123")
+    assert "abc.csv?" in url and "kpis=sessions" in url and "os_names=ios" in url
+
+    # Registered jobs are still available
+    assert adjust.get_job('retention', config) is adjust.Retention
+    with pytest.raises(click.BadParameter):
+        adjust.get_job('events', config)
+    with pytest.raises(click.BadParameter):
+        adjust.declare_job('events', {'kpis': {'events': 'Int64'}, 'endpoint': 'events'})
+
+
+combined_data = """adj_date,os,daus,waus,maus,installs,sessions
+2017-01-01,android,10,20,30,1,100
+2017-01-02,ios,20,40,60,,200
+"""
+
+
+def test_combined_job(tmpdir):
+    sessions = adjust.declare_job('sessions', {'kpis': {'sessions': 'Int64', 'installs': 'Int64'}})
+    job = adjust.combine([adjust.DailyActiveUsers, sessions])
+    assert job.KPIS == ['daus', 'waus', 'maus', 'installs', 'sessions']
+    assert "kpis=daus,waus,maus,installs,sessions" in job().build_url("abc", "123")
+
+    class MemoryCombinedJob(job):
+        def build_url(self, app_key, token, **kwargs):
+            return StringIO(combined_data)
+
+    apps = OrderedDict([('first', 'a'), ('second', 'b')])
+    paths = adjust.write_apps(apps, "123", MemoryCombinedJob, str(tmpdir))
+    assert len(paths) == 4
+
+    daus = pd.concat(pd.read_csv(p) for p in adjust.part_files(paths, adjust.DailyActiveUsers))
+    assert list(daus.columns) == ['adj_date', 'os', 'daus', 'waus', 'maus', 'installs', 'app']
+    assert list(daus['installs']) == [1, 0, 1, 0]
+    split = pd.concat(pd.read_csv(p) for p in adjust.part_files(paths, sessions))
+    assert list(split.columns) == ['adj_date', 'os', 'sessions', 'installs', 'app']
+    assert list(split['app']) == ['first', 'first', 'second', 'second']
+
+
+def run_combined(tmpdir, monkeypatch, execute, swap=False):
+    sessions = adjust.declare_job('sessions', {'kpis': {'sessions': 'Int64', 'installs': 'Int64'}})
+    monkeypatch.setattr(adjust.CombinedJob, 'build_url', lambda self, app_key, token, **kwargs: StringIO(combined_data),
+                        raising=False)
+    cnxn = mock.Mock()
+    cnxn.cursor.return_value.execute.side_effect = execute
+    cnxn.cursor.return_value.rowcount = 2
+    pool = collectors.common.ConnectionPool("vertica", connector=lambda dsn: cnxn)
+    config = {'data_dir': str(tmpdir), 'vertica': {'dsn': 'vertica', 'swap': swap},
+              'adjust': {'apps': {'first': 'a'}, 'token': '123'}}
+    adjust.run(config, pool, ['daus', 'sessions'], [adjust.DailyActiveUsers, sessions])
+    return cnxn
+
+
+def test_run_combined_commits_together(tmpdir, monkeypatch):
+    statements = []
+
+    def execute(statement):
+        statements.append(statement)
+        if statement.startswith("COPY sessions"):
+            raise IOError("vertica is down")
+
+    with pytest.raises(IOError):
+        run_combined(tmpdir, monkeypatch, execute)
+    # The daus table is neither truncated nor committed before sessions fails, the rollback restores it
+    assert statements[0] == "DELETE FROM daus"
+    assert not any(statement.startswith(("TRUNCATE", "COMMIT", "INSERT INTO last_updated"))
+                   for statement in statements)
+
+
+def test_run_combined_swaps_together(tmpdir, monkeypatch):
+    statements = []
+    cnxn = run_combined(tmpdir, monkeypatch, statements.append, swap=True)
+    assert statements.count("ALTER TABLE daus, daus_stage, sessions, sessions_stage "
+                            "RENAME TO daus_old, daus, sessions_old, sessions") == 1
+    assert not any(statement.startswith("COMMIT") for statement in statements)
+    assert cnxn.commit.call_count == 1
+
+
+def test_combine_incompatible():
+    with pytest.raises(click.BadParameter):
+        adjust.combine([adjust.DailyActiveUsers, adjust.Retention])
+    with pytest.raises(click.BadParameter):
+        adjust.run({'adjust': {}}, None, ['foo'], ['daily_active_users', 'retention'])
+
+
+def test_write_apps_unchanged(tmpdir):
+    apps = OrderedDict([('first', 'a'), ('second', 'b')])
+    content_hash = collectors.common.ContentHash(str(tmpdir), 'foo')
+    paths = adjust.write_apps(apps, "123", SlowJob, str(tmpdir), content_hash=content_hash)
+    content_hash.save()
+    for path in paths:
+        os.utime(path, (0, 0))
+
+    # The apps are hashed before they are written, unchanged ones are not written again
+    content_hash = collectors.common.ContentHash(str(tmpdir), 'foo')
+    assert adjust.write_apps(apps, "123", SlowJob, str(tmpdir), content_hash=content_hash) == paths
+    assert content_hash.unchanged()
+    assert [os.path.getmtime(path) for path in paths] == [0, 0]
+
+    # Unless their file is gone, or the window changed
+    os.remove(paths[0])
+    content_hash = collectors.common.ContentHash(str(tmpdir), 'foo', salt='2018-01-01')
+    adjust.write_apps(apps, "123", SlowJob, str(tmpdir), content_hash=content_hash)
+    assert not content_hash.unchanged()
+    assert all(os.path.getmtime(path) > 0 for path in paths)
+
+
+def test_adjust_url_window():
+    job = adjust.Retention()
+    url = job.build_url("abc", "123", start_date="2017-12-25")
+    assert "start_date=2017-12-25" in url
+    assert "end_date={}".format(adjust.HISTORY_END) in url
+
+
+def test_window_start(odbc):
+    odbc.fetchone.return_value = (datetime.date(2018, 1, 10),)
+    assert adjust.window_start(odbc, "foo", 7) == "2018-01-03"
+
+    odbc.fetchone.return_value = (None,)
+    assert adjust.window_start(odbc, "foo", 7) == adjust.HISTORY_START
+
+
 def test_load(odbc):
     collectors.common.load(odbc, "foo", "output.foo", "rejects", "exceptions")
     assert odbc.execute.call_count is 4  # Truncate, copy, insert, commit
 
 
+def test_load_window(odbc):
+    collectors.common.load(odbc, "foo", "output.foo", "rejects", "exceptions", where="adj_date >= '2018-01-03'")
+    assert odbc.execute.call_count == 4  # Delete, copy, insert, commit
+    assert odbc.execute.call_args_list[0][0][0] == "DELETE FROM foo WHERE adj_date >= '2018-01-03'"
+
+
+def test_load_swap(odbc):
+    collectors.common.load(odbc, "app.foo", "output.foo", "rejects", "exceptions", swap=True)
+    statements = [call[0][0] for call in odbc.execute.call_args_list]
+    assert statements[2] == "CREATE TABLE app.foo_stage LIKE app.foo INCLUDING PROJECTIONS"
+    assert statements[3].startswith("COPY app.foo_stage FROM LOCAL")
+    assert "'app.foo'" in statements[4]  # last_updated records the live table
+    assert statements[5] == "ALTER TABLE app.foo, app.foo_stage RENAME TO foo_old, foo"
+    assert statements[6] == "DROP TABLE app.foo_old"
+    assert not any(statement.startswith("TRUNCATE") for statement in statements)
+
+
+def test_load_swap_window(odbc):
+    collectors.common.load(odbc, "foo", "output.foo", "rejects", "exceptions", where="adj_date >= '2018-01-03'",
+                           swap=True)
+    statements = [call[0][0] for call in odbc.execute.call_args_list]
+    assert statements[3] == "INSERT /*+ DIRECT */ INTO foo_stage SELECT * FROM foo WHERE NOT (adj_date >= '2018-01-03')"
+    assert not any(statement.startswith("DELETE") for statement in statements)
+
+
 if __name__ == '__main__':
     test_colllect()
     test_adjust_url_builder()
@@ -0,0 +1,54 @@
+from unittest import mock
+
+import click
+import pytest
+
+from collectors import batch
+
+config = {'data_dir': '/tmp/data-collectors', 'vertica': {'dsn': 'vertica'}}
+
+
+@pytest.fixture
+def runners(monkeypatch):
+    def redash(config, pool, table, query_id, load_path, **kwargs):
+        if query_id == 'broken':
+            raise IOError("redash is down")
+        return dict(rows=2, bytes=10, fetch_secs=0.1, load_secs=0.2)
+
+    runners = dict(redash=mock.Mock(side_effect=redash), adjust=mock.Mock(return_value=dict(rows=5)))
+    monkeypatch.setattr(batch, 'RUNNERS', runners)
+    return runners
+
+
+def test_run_batch(runners):
+    jobs = [
+        dict(type='redash', table='foo', query_id='1', api_key='abc'),
+        dict(type='redash', table='bar', query_id='broken', api_key='abc'),
+        dict(type='adjust', table='baz', job='retention', name='retention'),
+    ]
+    pool = mock.Mock()
+    summaries = batch.run_batch(config, pool, jobs, parallelism=2)
+
+    assert [s['name'] for s in summaries] == ['redash-foo', 'redash-bar', 'retention']
+    assert [s['status'] for s in summaries] == ['ok', 'failed', 'ok']
+    assert summaries[0]['rows'] == 2
+    assert summaries[1]['error'] == "redash is down"
+    runners['adjust'].assert_called_once_with(config, pool, table='baz', job='retention',
+                                              load_path='/tmp/data-collectors/batch/retention')
+    assert 'redash-bar' in batch.format_summary(summaries)
+
+
+def test_validate(runners):
+    with pytest.raises(click.BadParameter):
+        batch.validate([dict(type='ftp', table='foo')])
+    with pytest.raises(click.BadParameter):
+        batch.validate([dict(type='redash', table='foo'), dict(type='redash', table='foo')])
+
+
+def test_combined_job_name(runners):
+    spec = dict(type='adjust', table=['daus', 'sessions'], job=['daily_active_users', 'sessions'])
+    assert batch.job_name(spec) == 'adjust-daus,sessions'
+
+    summary = batch.run_job(config, mock.Mock(), spec)
+    assert summary['table'] == 'daus,sessions'
+    assert runners['adjust'].call_args[1]['table'] == ['daus', 'sessions']
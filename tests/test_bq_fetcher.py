@@ -0,0 +1,138 @@
+import sys
+import threading
+import types
+
+import pytest
+
+from collectors import bq_fetcher
+
+
+class Request(object):
+    def __init__(self, response, retries=None):
+        self.response = response
+        self.retries = retries
+
+    def execute(self, num_retries=0):
+        if self.retries is not None:
+            self.retries.append(num_retries)
+        return self.response() if callable(self.response) else self.response
+
+
+class FakeJobs(object):
+    """
+    Stand-in for bigquery.jobs(), each job reports DONE after a given number of polls
+    """
+    def __init__(self, polls, errors=None):
+        self.polls = dict(polls)
+        self.errors = errors or {}
+        self.tables = {}
+        self.gets = []
+        self.retries = []
+
+    def insert(self, projectId, body):
+        job_id = body['jobReference']['jobId']
+        self.tables[job_id] = body['configuration']['load']['destinationTable']['tableId']
+        return Request(body)
+
+    def get(self, projectId, jobId):
+        table = self.tables[jobId]
+        self.gets.append(table)
+
+        def status():
+            self.polls[table] -= 1
+            if self.polls[table] > 0:
+                return {'status': {'state': 'RUNNING'}}
+            if table in self.errors:
+                return {'status': {'state': 'DONE', 'errorResult': self.errors[table]}}
+            return {'status': {'state': 'DONE'}}
+        return Request(status, self.retries)
+
+
+class FakeBigQuery(object):
+    def __init__(self, jobs):
+        self._jobs = jobs
+
+    def jobs(self):
+        return self._jobs
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(bq_fetcher.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_load_tables_concurrently(sleeps):
+    jobs = FakeJobs({'a': 1, 'b': 4, 'c': 2})
+    loads = [(table, [], 'gs://bucket/{}/*'.format(table)) for table in 'abc']
+
+    summaries = bq_fetcher.load_tables(FakeBigQuery(jobs), 'project', 'dataset', loads, poll_interval=2)
+    assert [s['table'] for s in summaries] == ['a', 'b', 'c']
+    assert all(s['state'] == 'DONE' for s in summaries)
+    # Every round polls all the unfinished jobs, with an exponential backoff between rounds
+    assert jobs.gets == ['a', 'b', 'c', 'b', 'c', 'b', 'b']
+    assert sleeps == [2, 4, 8]
+
+
+def test_load_tables_retries(sleeps):
+    jobs = FakeJobs({'a': 2})
+    bq_fetcher.load_tables(FakeBigQuery(jobs), 'project', 'dataset', [('a', [], 'gs://bucket/a')], num_retries=7)
+    assert jobs.retries == [7, 7]
+
+
+def test_poll_backoff_is_capped(sleeps):
+    jobs = FakeJobs({'a': 10})
+    bq_fetcher.load_tables(FakeBigQuery(jobs), 'project', 'dataset', [('a', [], 'gs://bucket/a')])
+    assert max(sleeps) == bq_fetcher.MAX_POLL_INTERVAL
+
+
+def test_failed_job(sleeps):
+    jobs = FakeJobs({'a': 1, 'b': 3}, errors={'a': {'reason': 'invalid'}})
+    bigquery = FakeBigQuery(jobs)
+    submitted = bq_fetcher.submit_jobs(bigquery, 'project', 'dataset', [('a', [], 'gs://a'), ('b', [], 'gs://b')])
+
+    with pytest.raises(RuntimeError):
+        bq_fetcher.poll_jobs(bigquery, submitted)
+    # The other jobs are still waited for
+    assert jobs.polls['b'] == 0
+
+
+def test_load_table_uris():
+    jobs = FakeJobs({})
+    bigquery = FakeBigQuery(jobs)
+
+    job = bq_fetcher.load_table(bigquery, 'project', 'dataset', 'a', [], 'gs://bucket/a.csv')
+    assert job['configuration']['load']['sourceUris'] == ['gs://bucket/a.csv']
+
+    uris = ('gs://bucket/2018-01-*.csv', 'gs://bucket/2018-02-*.csv')
+    job = bq_fetcher.load_table(bigquery, 'project', 'dataset', 'a', [], uris)
+    assert job['configuration']['load']['sourceUris'] == list(uris)
+
+
+def test_load_schema_cached(tmpdir):
+    schema_file = tmpdir.join('schema.json')
+    schema_file.write('[{"name": "foo", "type": "STRING"}]')
+
+    schema = bq_fetcher.load_schema(str(schema_file))
+    schema_file.write('[]')
+    assert bq_fetcher.load_schema(str(schema_file)) is schema
+
+
+def test_service_per_thread(monkeypatch):
+    discovery = types.ModuleType('googleapiclient.discovery')
+    discovery.build = lambda name, version: object()
+    googleapiclient = types.ModuleType('googleapiclient')
+    googleapiclient.discovery = discovery
+    monkeypatch.setitem(sys.modules, 'googleapiclient', googleapiclient)
+    monkeypatch.setitem(sys.modules, 'googleapiclient.discovery', discovery)
+
+    services = []
+    thread = threading.Thread(target=lambda: services.append(bq_fetcher.get_service()))
+    thread.start()
+    thread.join()
+    services += [bq_fetcher.get_service(), bq_fetcher.get_service()]
+
+    # Reused within a thread, never shared between threads
+    assert services[1] is services[2]
+    assert services[0] is not services[1]
@@ -0,0 +1,140 @@
+import gzip
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+from collectors.common import ConnectionPool, ContentHash, copy_statement, stream_to_file, write_to_file
+
+
+@pytest.fixture
+def connector():
+    return mock.Mock(side_effect=lambda dsn: mock.Mock())
+
+
+def test_pool_reuses_connections(connector):
+    pool = ConnectionPool("vertica", connector=connector)
+
+    with pool.cursor() as cursor:
+        cursor.execute("SELECT 1")
+    with pool.cursor() as cursor:
+        cursor.execute("SELECT 2")
+
+    assert connector.call_count == 1
+    connector.assert_called_with("DSN=vertica")
+
+
+def test_pool_commit_and_rollback(connector):
+    pool = ConnectionPool("vertica", connector=connector)
+
+    with pool.cursor():
+        pass
+    cnxn = pool.acquire()
+    assert cnxn.commit.call_count == 1
+    pool.release(cnxn)
+
+    with pytest.raises(ValueError):
+        with pool.cursor():
+            raise ValueError("load failed")
+    assert cnxn.rollback.call_count == 1
+
+    # The connection survived the rollback and is reused
+    assert pool.acquire() is cnxn
+
+
+def test_pool_drops_unhealthy_connections(connector):
+    pool = ConnectionPool("vertica", connector=connector)
+    stale = pool.acquire()
+    pool.release(stale)
+    stale.cursor.return_value.execute.side_effect = Exception("connection lost")
+
+    fresh = pool.acquire()
+    assert fresh is not stale
+    assert stale.close.call_count == 1
+    assert connector.call_count == 2
+
+
+def test_pool_close(connector):
+    with ConnectionPool("vertica", size=1, connector=connector) as pool:
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)  # pool is full
+        assert second.close.call_count == 1
+
+    assert first.close.call_count == 1
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+
+def test_copy_statement_formats():
+    csv = copy_statement("foo", "/data/output.csv", "rejects", "exceptions")
+    assert csv.startswith("COPY foo FROM LOCAL '/data/output.csv' DELIMITER ',' SKIP 1 ")
+
+    gz = copy_statement("foo", "/data/output.csv.gz", "rejects", "exceptions", fmt='csv.gz')
+    assert "FROM LOCAL '/data/output.csv.gz' GZIP DELIMITER ','" in gz
+
+    parquet = copy_statement("foo", "/data/output.parquet", "rejects", "exceptions", fmt='parquet')
+    assert parquet == "COPY foo FROM '/data/output.parquet' ON ANY NODE PARQUET ABORT ON ERROR DIRECT"
+
+    with pytest.raises(ValueError):
+        copy_statement("foo", "/data/output.xls", "rejects", "exceptions", fmt='xls')
+
+
+def test_copy_statement_files():
+    csv = copy_statement("foo", ["/data/a.csv", "/data/b.csv"], "rejects", "exceptions")
+    assert csv.startswith("COPY foo FROM LOCAL '/data/a.csv', '/data/b.csv' DELIMITER ',' SKIP 1 ")
+
+    parquet = copy_statement("foo", ["/data/a.parquet", "/data/b.parquet"], "rejects", "exceptions", fmt='parquet')
+    assert parquet.startswith("COPY foo FROM '/data/a.parquet' ON ANY NODE, '/data/b.parquet' ON ANY NODE PARQUET")
+
+
+def test_write_to_file_formats(tmpdir):
+    df = pd.DataFrame({'adj_date': ['2018-01-01', '2018-01-02'], 'installs': [1, 2]}, index=[5, 6])
+
+    gz = write_to_file(df, str(tmpdir), fmt='csv.gz')
+    assert gz == str(tmpdir.join('output.csv.gz'))
+    assert pd.read_csv(gz).equals(df.reset_index(drop=True))
+
+    pytest.importorskip('pyarrow')
+    parquet = write_to_file(df, str(tmpdir), fmt='parquet')
+    assert parquet == str(tmpdir.join('output.parquet'))
+    loaded = pd.read_parquet(parquet)
+    assert list(loaded.columns) == ['adj_date', 'installs']
+    assert str(loaded['installs'].dtype) == 'int64'
+
+
+def test_stream_to_file_gzip(tmpdir):
+    output = stream_to_file([b"foo,bar\n", "1,2\n"], str(tmpdir), fmt='csv.gz')
+    with gzip.open(output) as f:
+        assert f.read() == b"foo,bar\n1,2\n"
+    with pytest.raises(ValueError):
+        stream_to_file([], str(tmpdir), fmt='parquet')
+
+
+def test_content_hash(tmpdir):
+    df = pd.DataFrame({'foo': [1, 2], 'bar': ['a', 'b']})
+
+    first = ContentHash(str(tmpdir), 'foo')
+    first.update_frame(df)
+    assert not first.unchanged()
+    first.save()
+
+    same = ContentHash(str(tmpdir), 'foo')
+    same.update_frame(df.copy())
+    assert same.unchanged()
+
+    forced = ContentHash(str(tmpdir), 'foo', force=True)
+    forced.update_frame(df)
+    assert not forced.unchanged()
+
+    other_table = ContentHash(str(tmpdir), 'bar')
+    other_table.update_frame(df)
+    assert not other_table.unchanged()
+
+    changed = ContentHash(str(tmpdir), 'foo')
+    changed.update_frame(df.assign(foo=[1, 3]))
+    assert not changed.unchanged()
+
+    window = ContentHash(str(tmpdir), 'foo', salt='2018-01-01')
+    window.update_frame(df)
+    assert not window.unchanged()
@@ -0,0 +1,262 @@
+import http.server
+import os
+import threading
+
+import pytest
+import requests
+
+from collections import OrderedDict
+
+from collectors import adjust, fetch, redash
+from collectors.common import ContentHash
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b"a,b\n1,2\n"
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append(dict(path=self.path, etag=self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(url, cache=None, source=None, content_hash=None):
+    with fetch.open_url(url, cache, source, content_hash) as body:
+        return body.read()
+
+
+def test_strip_secrets():
+    assert fetch.strip_secrets("https://x/q.csv?api_key=abc&id=1") == "https://x/q.csv?id=1"
+    assert fetch.strip_secrets("https://x/kpis.csv?user_token=abc") == "https://x/kpis.csv"
+
+
+def test_conditional_fetch(server, tmpdir):
+    cache = fetch.ResponseCache(str(tmpdir))
+
+    assert read(server + "/results.csv?api_key=one", cache) == Handler.body
+    # Another api key maps to the same cache entry, the server answers 304 and the body comes from disk
+    assert read(server + "/results.csv?api_key=two", cache) == Handler.body
+    assert [r['etag'] for r in Handler.requests] == [None, '"v1"']
+    assert cache.lookup(server + "/results.csv")['url'] == server + "/results.csv"
+
+
+def test_cached_while_read(server, tmpdir):
+    cache = fetch.ResponseCache(str(tmpdir))
+
+    with fetch.open_url(server + "/results.csv", cache) as body:
+        assert body.read(3) == Handler.body[:3]
+        # Nothing is buffered ahead of the reader
+        assert cache.lookup(server + "/results.csv") is None
+        assert body.read() == Handler.body[3:]
+    assert cache.lookup(server + "/results.csv")['size'] == len(Handler.body)
+
+    # A body that wasn't read to the end isn't cached
+    with fetch.open_url(server + "/partial.csv", cache) as body:
+        body.read(3)
+    assert cache.lookup(server + "/partial.csv") is None
+    assert [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')] == []
+
+
+def test_not_modified_since_load(server, tmpdir):
+    cache = fetch.ResponseCache(str(tmpdir.join('cache')))
+    load_path = str(tmpdir.join('load'))
+
+    content_hash = ContentHash(load_path, 'foo')
+    assert read(server + "/results.csv", cache, content_hash=content_hash) == Handler.body
+    # Revalidated but not loaded yet, the cached body is read back
+    assert read(server + "/results.csv", cache, content_hash=ContentHash(load_path, 'foo')) == Handler.body
+    content_hash.save()
+
+    with pytest.raises(fetch.NotModified):
+        read(server + "/results.csv", cache, content_hash=ContentHash(load_path, 'foo'))
+    # Another window or table wasn't loaded from it
+    assert read(server + "/results.csv", cache, content_hash=ContentHash(load_path, 'foo', salt='2018')) == Handler.body
+    assert read(server + "/results.csv", cache, content_hash=ContentHash(load_path, 'bar')) == Handler.body
+    assert read(server + "/results.csv", cache,
+                content_hash=ContentHash(load_path, 'foo', force=True)) == Handler.body
+
+
+def test_redash_not_modified(server, tmpdir):
+    fetch.configure({'cache_dir': str(tmpdir.join('cache'))})
+    load_path = str(tmpdir.join('load'))
+    try:
+        content_hash = ContentHash(load_path, 'foo')
+        assert redash.collect(server + "/results.csv", load_path, content_hash=content_hash) is not None
+        content_hash.save()
+        tmpdir.join('load', 'output.csv').remove()
+
+        for stream in (False, True):
+            content_hash = ContentHash(load_path, 'foo')
+            assert redash.collect(server + "/results.csv", load_path, stream, content_hash=content_hash) is None
+            assert content_hash.unchanged()
+        assert not tmpdir.join('load', 'output.csv').check()
+    finally:
+        fetch.configure()
+
+
+def test_adjust_not_modified(server, tmpdir):
+    fetch.configure({'cache_dir': str(tmpdir.join('cache'))})
+    load_path = str(tmpdir.join('load'))
+    apps = OrderedDict([('a', 'a'), ('b', 'b')])
+
+    class ServedJob(adjust.DailyActiveUsers):
+        COLUMNS = ['adj_date', 'os']
+        DTYPES = {}
+
+        def build_url(self, app_key, token, **kwargs):
+            return "{}/{}.csv".format(server, app_key)
+
+        def transform(self, df, app_name):
+            return adjust.AdjustJob.transform(self, df, app_name)
+
+    def write_apps():
+        content_hash = ContentHash(load_path, 'foo')
+        paths = adjust.write_apps(apps, "token", ServedJob, load_path, content_hash=content_hash)
+        return paths, content_hash
+
+    try:
+        paths, content_hash = write_apps()
+        content_hash.save()
+
+        # b is read back from the cache to write its missing file, a is kept as it is
+        os.remove(paths[1])
+        mtime = os.path.getmtime(paths[0])
+        again, content_hash = write_apps()
+        assert again == paths and os.path.exists(paths[1])
+        assert os.path.getmtime(paths[0]) == mtime
+        assert content_hash.unchanged()
+    finally:
+        fetch.configure()
+
+
+def test_no_cache(server):
+    assert read(server + "/results.csv") == Handler.body
+    assert read(server + "/results.csv") == Handler.body
+    assert [r['etag'] for r in Handler.requests] == [None, None]
+
+
+def test_eviction(server, tmpdir):
+    cache = fetch.ResponseCache(str(tmpdir), max_mb=len(Handler.body) * 2 / 1024 / 1024)
+
+    for name in ('a', 'b'):
+        read("{}/{}.csv".format(server, name), cache)
+    os.utime(cache.paths(cache.key(server + "/b.csv"))[0], (0, 0))
+    read(server + "/c.csv", cache)
+
+    # b was the least recently used entry
+    assert cache.lookup(server + "/a.csv") is not None
+    assert cache.lookup(server + "/b.csv") is None
+    assert cache.lookup(server + "/c.csv") is not None
+
+
+def test_pass_through():
+    body = object()
+    with fetch.open_url(body) as opened:
+        assert opened is body
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers 502 to the first `failures` requests, then 200.  /slow never answers in time.
+    """
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+    requests = 0
+
+    def do_GET(self):
+        FlakyHandler.requests += 1
+        if self.path == '/slow':
+            # time.sleep is patched away by the fixture
+            threading.Event().wait(1)
+        status = 502 if FlakyHandler.requests <= FlakyHandler.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def flaky(monkeypatch):
+    monkeypatch.setattr(fetch.time, 'sleep', lambda secs: None)
+    FlakyHandler.requests = 0
+    FlakyHandler.failures = 0
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(httpd.server_port)
+    fetch.configure()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retries(flaky):
+    FlakyHandler.failures = 2
+    fetch.configure({'sources': {'adjust': {'retries': 2}}})
+    assert read(flaky + "/data.csv?user_token=abc", source='adjust') == b"ok"
+    assert FlakyHandler.requests == 3
+
+
+def test_retries_exhausted(flaky):
+    FlakyHandler.failures = 5
+    fetch.configure({'retries': 1})
+    with pytest.raises(requests.HTTPError):
+        read(flaky + "/data.csv")
+    assert FlakyHandler.requests == 2
+
+
+def test_timeout(flaky):
+    fetch.configure({'read_timeout': 0.1, 'retries': 0})
+    with pytest.raises(requests.Timeout):
+        read(flaky + "/slow")
+
+
+def test_circuit_breaker(flaky):
+    FlakyHandler.failures = 100
+    fetch.configure({'retries': 0, 'failure_threshold': 2, 'reset_secs': 60})
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            read(flaky + "/data.csv")
+    with pytest.raises(fetch.CircuitOpen):
+        read(flaky + "/data.csv")
+    assert FlakyHandler.requests == 2
+
+
+def test_retry_budget():
+    budget = fetch.RetryBudget(0.5, min_retries=1)
+    for _ in range(4):
+        budget.request()
+    assert [budget.try_retry() for _ in range(4)] == [True, True, True, False]
+
+
+def test_policy_settings():
+    with pytest.raises(ValueError):
+        fetch.FetchPolicy(retrys=3)
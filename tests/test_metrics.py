@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+from io import StringIO
+
+import pytest
+
+from collectors import metrics
+from collectors.redash import collect
+
+
+def test_run_metrics(caplog):
+    caplog.set_level(logging.INFO, logger='collectors.metrics')
+    with metrics.RunMetrics('adjust', 'foo') as run_metrics:
+        for rows in (2, 3):
+            with run_metrics.stage('fetch') as stage:
+                stage['rows'] = rows
+        run_metrics.record('fetch', max_read_secs=4, bytes=None)
+        run_metrics.record('fetch', max_read_secs=1)
+
+    rows = [record.metrics for record in caplog.records]
+    assert [row['stage'] for row in rows] == ['fetch', 'total']
+    assert rows[0]['rows'] == 5
+    assert rows[0]['max_read_secs'] == 4
+    assert 'bytes' not in rows[0]
+    assert rows[0]['peak_rss_bytes'] > 0
+    assert rows[1]['status'] == 'ok'
+
+
+def test_run_metrics_failed(caplog):
+    caplog.set_level(logging.INFO, logger='collectors.metrics')
+    with pytest.raises(IOError):
+        with metrics.RunMetrics('redash', 'foo'):
+            raise IOError("redash is down")
+    assert caplog.records[-1].metrics['status'] == 'failed'
+
+
+def test_json_formatter():
+    record = logging.LogRecord('collectors.metrics', logging.INFO, __file__, 1, "redash foo load", None, None)
+    record.metrics = {'stage': 'load', 'rows': 2}
+    line = json.loads(metrics.JsonFormatter().format(record))
+    assert line['message'] == "redash foo load"
+    assert line['rows'] == 2
+
+
+def test_log_file(tmpdir):
+    path = str(tmpdir.join('metrics.jsonl'))
+    metrics.configure({'log_file': path})
+    try:
+        with metrics.RunMetrics('adjust', 'foo'):
+            pass
+    finally:
+        metrics.configure()
+
+    lines = [json.loads(line) for line in tmpdir.join('metrics.jsonl').read().splitlines()]
+    assert [(line['table'], line['stage'], line['status']) for line in lines] == [('foo', 'total', 'ok')]
+    assert not metrics.logger.handlers
+
+
+def test_textfile(tmpdir, monkeypatch):
+    path = str(tmpdir.join('collectors.prom'))
+    monkeypatch.setattr(metrics, '_textfile', path)
+
+    with metrics.RunMetrics('redash', 'foo') as run_metrics:
+        with run_metrics.stage('load') as stage:
+            stage['rows'] = 2
+    with metrics.RunMetrics('redash', 'bar') as run_metrics:
+        run_metrics.status = 'unchanged'
+
+    lines = tmpdir.join('collectors.prom').read().splitlines()
+    assert 'data_collectors_rows{collector="redash",table="foo",stage="load"} 2' in lines
+    assert 'data_collectors_failed{collector="redash",table="bar",stage="total"} 0' in lines
+
+
+def test_textfile_processes(tmpdir):
+    path = str(tmpdir.join('collectors.prom'))
+    script = ("from collectors import metrics\n"
+              "metrics.write_textfile({!r}, [{{'collector': {!r}, 'table': {!r}, 'stage': 'load', 'rows': {}}}])")
+    for collector, table, rows in [('redash', 'foo', 2), ('adjust', 'bar', 3), ('redash', 'foo', 4)]:
+        subprocess.check_call([sys.executable, '-c', script.format(path, collector, table, rows)])
+
+    lines = tmpdir.join('collectors.prom').read().splitlines()
+    assert lines == ['# HELP data_collectors_rows Rows processed by the stage',
+                     '# TYPE data_collectors_rows gauge',
+                     'data_collectors_rows{collector="redash",table="foo",stage="load"} 4',
+                     'data_collectors_rows{collector="adjust",table="bar",stage="load"} 3']
+
+
+def test_textfile_format(tmpdir):
+    path = str(tmpdir.join('collectors.prom'))
+    table = 'app."foo"\\bar\n'
+    metrics.write_textfile(path, [{'collector': 'redash', 'table': table, 'stage': 'total', 'status': 'ok',
+                                   'secs': 1.5, 'rows': 2}])
+    metrics.write_textfile(path, [{'collector': 'adjust', 'table': 'bar', 'stage': 'total', 'status': 'failed',
+                                   'secs': 3}])
+
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    lines = tmpdir.join('collectors.prom').read().splitlines()
+    assert lines[:4] == ['# HELP data_collectors_secs Wall time of the stage in seconds',
+                         '# TYPE data_collectors_secs gauge',
+                         'data_collectors_secs{collector="redash",table="app.\\"foo\\"\\\\bar\\n",stage="total"} 1.5',
+                         'data_collectors_secs{collector="adjust",table="bar",stage="total"} 3']
+    assert lines.count('# TYPE data_collectors_failed gauge') == 1
+    assert list(metrics.read_textfile(path)) == [('redash', table, 'total'), ('adjust', 'bar', 'total')]
+
+
+def test_collect_stages(tmpdir):
+    run_metrics = metrics.RunMetrics('redash', 'foo')
+    collect(StringIO("a,b\n1,2\n3,4\n"), str(tmpdir), metrics=run_metrics)
+    assert list(run_metrics.stages) == ['fetch', 'serialize']
+    assert run_metrics.stages['fetch']['rows'] == 2
+    assert run_metrics.stages['serialize']['bytes'] == len("a,b\n1,2\n3,4\n")
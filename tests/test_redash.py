@@ -1,8 +1,13 @@
+import http.server
+import json
+import threading
 from io import StringIO
 from unittest import mock
 
 import pytest
 
+from collectors import redash
+from collectors.common import ContentHash
 from collectors.redash import collect
 
 test_data = """
@@ -23,3 +28,132 @@ def test_collect(tmpdir):
 
     output = collect(input, path)
     assert output == path.join('output.csv')
+
+
+def test_collect_dtypes(tmpdir):
+    path = tmpdir.mkdir("redash")
+    data = "day,channel,searches\n2018-01-01,release,10\n2018-01-02,beta,\n"
+
+    collect(StringIO(data), str(path), dtypes={'channel': 'category', 'searches': 'Int64'}, parse_dates=['day'],
+            chunksize=1)
+    assert path.join('output.csv').read() == data
+
+
+def test_collect_chunks(tmpdir, monkeypatch):
+    path = str(tmpdir.mkdir("redash"))
+    # CSV results are written chunk by chunk, never as a whole frame
+    monkeypatch.setattr(redash, 'concat_frames', mock.Mock(side_effect=AssertionError))
+    run_metrics = redash.RunMetrics('redash', 'foo')
+
+    content_hash = ContentHash(path, 'foo')
+    output = collect(StringIO(test_data), path, content_hash=content_hash, chunksize=1, metrics=run_metrics)
+    assert open(output).read() == test_data.lstrip()
+    assert run_metrics.stages['fetch']['rows'] == 2
+    assert run_metrics.stages['serialize']['bytes'] == len(test_data.lstrip())
+    content_hash.save()
+
+    content_hash = ContentHash(path, 'foo')
+    assert collect(StringIO(test_data), path, content_hash=content_hash, chunksize=1) is None
+    assert content_hash.unchanged()
+
+
+def test_collect_stream(tmpdir):
+    input = StringIO(test_data)
+    path = tmpdir.mkdir("redash")
+
+    output = collect(input, str(path), stream=True)
+    assert output == path.join('output.csv')
+    assert path.join('output.csv').read() == test_data
+
+
+def test_collect_unchanged(tmpdir):
+    path = str(tmpdir.mkdir("redash"))
+
+    content_hash = ContentHash(path, 'foo')
+    assert collect(StringIO(test_data), path, content_hash=content_hash) is not None
+    content_hash.save()
+
+    content_hash = ContentHash(path, 'foo')
+    assert collect(StringIO(test_data), path, content_hash=content_hash) is None
+    assert content_hash.unchanged()
+
+    # Streams are hashed as they are written
+    content_hash = ContentHash(path, 'foo')
+    collect(StringIO(test_data), path, stream=True, content_hash=content_hash)
+    content_hash.save()
+    content_hash = ContentHash(path, 'foo')
+    collect(StringIO(test_data), path, stream=True, content_hash=content_hash)
+    assert content_hash.unchanged()
+
+
+class FakeRedash(http.server.BaseHTTPRequestHandler):
+    """
+    Refresh API of redash: query 1 runs for two polls, query 2 fails and query 3 has a fresh cached result
+    """
+    protocol_version = 'HTTP/1.1'
+    polls = {}
+
+    def reply(self, payload, content_type='application/json'):
+        body = payload.encode('utf-8') if content_type == 'text/csv' else json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        query_id = self.path.split('/')[3]
+        if query_id == '3':
+            return self.reply({'query_result': {'id': 30}})
+        self.reply({'job': {'id': 'job-' + query_id, 'status': 1}})
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/api/jobs/'):
+            job_id = path.split('/')[-1]
+            FakeRedash.polls[job_id] = FakeRedash.polls.get(job_id, 0) + 1
+            if job_id == 'job-2':
+                return self.reply({'job': {'id': job_id, 'status': 4, 'error': 'syntax error'}})
+            status = 3 if FakeRedash.polls[job_id] >= 2 else 2
+            return self.reply({'job': {'id': job_id, 'status': status, 'query_result_id': 10}})
+        self.reply(test_data, 'text/csv')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_redash(monkeypatch):
+    monkeypatch.setattr(redash.time, 'sleep', lambda secs: None)
+    FakeRedash.polls = {}
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeRedash)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_refresh_query(fake_redash, tmpdir):
+    assert redash.refresh_query(fake_redash, 'key', 1) == 10
+    assert FakeRedash.polls == {'job-1': 2}
+
+    url = redash.REDASH_RESULT_URL_TMPL.format(base_url=fake_redash, result_id=10, api_key='key')
+    output = collect(url, str(tmpdir))
+    assert tmpdir.join('output.csv').read() == "foo,bar,baz\n1,2,3\n3,4,5\n"
+    assert output == str(tmpdir.join('output.csv'))
+
+
+def test_refresh_query_max_age(fake_redash):
+    assert redash.refresh_query(fake_redash, 'key', 3, max_age=3600) == 30
+    assert FakeRedash.polls == {}
+
+
+def test_refresh_query_failed(fake_redash):
+    with pytest.raises(RuntimeError, match='syntax error'):
+        redash.refresh_query(fake_redash, 'key', 2)
+
+
+def test_refresh_query_timeout(fake_redash):
+    with pytest.raises(TimeoutError):
+        redash.refresh_query(fake_redash, 'key', 1, timeout=-1)
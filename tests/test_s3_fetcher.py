@@ -0,0 +1,342 @@
+import bz2
+import gzip
+import hashlib
+import io
+from unittest import mock
+
+import pytest
+
+from collectors import s3_fetcher
+from collectors.common import ConnectionPool
+
+PART_SIZE = 10
+
+
+class FakeS3(object):
+    """
+    Answers get_object/head_object for a single object held in memory, uploaded in parts of PART_SIZE
+    unless multipart is False
+    """
+    def __init__(self, data, failures=None, multipart=True, part_sizes=None):
+        self.data = data
+        self.failures = dict(failures or {})
+        self.multipart = multipart
+        self.part_sizes = part_sizes
+        self.calls = []
+
+    def part_bounds(self, part_number):
+        if self.part_sizes:
+            start = sum(self.part_sizes[:part_number - 1])
+            return start, start + self.part_sizes[part_number - 1]
+        start = (part_number - 1) * PART_SIZE
+        return start, min(start + PART_SIZE, len(self.data))
+
+    def etag(self):
+        if not self.multipart:
+            return '"%s"' % hashlib.md5(self.data).hexdigest()
+        bounds = [self.part_bounds(n) for n in range(1, self.parts_count() + 1)]
+        digests = b"".join(hashlib.md5(self.data[start:end]).digest() for start, end in bounds)
+        return '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(bounds))
+
+    def parts_count(self):
+        if self.part_sizes:
+            return len(self.part_sizes)
+        return (len(self.data) + PART_SIZE - 1) // PART_SIZE
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        head = {'ContentLength': len(self.data), 'ETag': self.etag(), 'Metadata': {'source': 'test'}}
+        if PartNumber is not None and self.multipart:
+            start, end = self.part_bounds(PartNumber)
+            head.update(ContentLength=end - start, PartsCount=self.parts_count())
+        return head
+
+    def get_object(self, Bucket, Key, PartNumber=None, Range=None):
+        call = PartNumber or Range
+        self.calls.append(call)
+        if self.failures.get(call, 0) > 0:
+            self.failures[call] -= 1
+            raise IOError("connection reset")
+        if Range:
+            start, end = [int(b) for b in Range[len("bytes="):].split('-')]
+            end = min(end + 1, len(self.data))
+        else:
+            start, end = self.part_bounds(PartNumber)
+        return {'Body': io.BytesIO(self.data[start:end]), 'ContentLength': end - start}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3_fetcher, 'RETRY_BACKOFF_SECS', 0)
+
+
+def test_fetch_in_order():
+    data = bytes(range(256)) * 4
+    s3 = FakeS3(data)
+    fout = io.BytesIO()
+
+    failed, metadata = s3_fetcher.fetch(s3, 'bucket', 'key', fout, threads=4, max_buffer_bytes=5 * PART_SIZE)
+    assert failed == 0
+    assert fout.getvalue() == data
+    assert metadata == {'source': 'test'}
+    assert sorted(s3.calls) == list(range(1, 104))
+
+
+def test_fetch_retries_parts():
+    data = b"x" * 95
+    s3 = FakeS3(data, failures={3: 2})
+
+    failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', io.BytesIO(), retries=3)
+    assert failed == 0
+    assert s3.calls.count(3) == 3
+
+
+def test_fetch_gives_up():
+    s3 = FakeS3(b"x" * 95, failures={3: 5})
+
+    failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', io.BytesIO(), retries=2)
+    assert failed == 1
+    assert s3.calls.count(3) == 2
+
+
+def test_buffer_limit():
+    parts = s3_fetcher.Parts(FakeS3(b""), 'bucket', 'key', 100, io.BytesIO(), part_size=8,
+                             threads=10, max_buffer_bytes=32)
+    assert parts.max_buffered == 4
+    assert parts.max_running == 4
+
+
+def test_fetch_resumable(tmpdir):
+    data = bytes(range(256)) * 2
+    path = str(tmpdir.join('output'))
+
+    # The first run dies on the 7th range, the ranges that made it are checkpointed
+    s3 = FakeS3(data, failures={"bytes=60-69": 1})
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=1, retries=1, range_size=PART_SIZE)
+    assert failed == 1
+    assert tmpdir.join('output.parts').check()
+    assert 7 not in s3_fetcher.read_checkpoint(path + '.parts', s3.etag(), PART_SIZE)
+
+    # The second run only downloads what is missing
+    s3.calls = []
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, range_size=PART_SIZE)
+    assert failed == 0
+    assert "bytes=60-69" in s3.calls
+    assert "bytes=0-9" not in s3.calls
+    assert tmpdir.join('output').read_binary() == data
+    assert not tmpdir.join('output.parts').check()
+
+
+def test_fetch_resumable_unequal_parts(tmpdir):
+    # Uploaders can mix part sizes, the parts can't be written at (part number - 1) * size of part 1
+    data = bytes(range(256))
+    s3 = FakeS3(data, part_sizes=[100, 50, 80, 26])
+    path = str(tmpdir.join('output'))
+
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4)
+    assert failed == 0
+    assert tmpdir.join('output').read_binary() == data
+    assert all(str(call).startswith("bytes=") for call in s3.calls)
+
+
+def test_fetch_resumable_lost_file(tmpdir):
+    data = bytes(range(256))
+    path = str(tmpdir.join('output'))
+    s3 = FakeS3(data, multipart=False, failures={"bytes=0-9": 1})
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=1, retries=1, range_size=PART_SIZE)
+    assert failed == 1
+
+    # The checkpoint can't be trusted once the file is gone, everything is downloaded again
+    tmpdir.join('output').remove()
+    s3.calls = []
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, range_size=PART_SIZE)
+    assert failed == 0
+    assert "bytes=10-19" in s3.calls
+    assert tmpdir.join('output').read_binary() == data
+
+
+def test_fetch_resumable_verified(tmpdir):
+    data = bytes(range(256))
+    path = str(tmpdir.join('output'))
+    s3 = FakeS3(data, multipart=False, failures={"bytes=200-209": 1})
+    s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=1, retries=1, range_size=PART_SIZE)
+
+    # A resumed download is checked against the ETag, the parts written by the first run included
+    with open(path, 'r+b') as f:
+        f.seek(20)
+        f.write(b"corrupted")
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, range_size=PART_SIZE)
+    assert failed == 1
+    assert not tmpdir.join('output.parts').check()
+
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, range_size=PART_SIZE)
+    assert failed == 0
+    assert tmpdir.join('output').read_binary() == data
+
+
+def test_checkpoint_other_version(tmpdir):
+    checkpoint = tmpdir.join('output.parts')
+    checkpoint.write('{"ETag": "\\"old\\"", "part_size": 10}\n1\n2\n')
+    assert s3_fetcher.read_checkpoint(str(checkpoint), '"abc"', 10) == set()
+    assert s3_fetcher.read_checkpoint(str(checkpoint), '"old"', 20) == set()
+    assert s3_fetcher.read_checkpoint(str(checkpoint), '"old"', 10) == {1, 2}
+
+
+def test_status_counters():
+    data = b"y" * 95
+    parts = s3_fetcher.Parts(FakeS3(data), 'bucket', 'key', 10, io.BytesIO(), part_size=PART_SIZE)
+    assert parts.download() == 0
+    assert parts.num_written() == parts.num_downloaded() == 10
+    assert parts.num_running() == parts.num_failed() == 0
+    assert parts.fout.getvalue() == data
+
+
+def test_fetch_ranges():
+    data = bytes(range(256)) * 3
+    s3 = FakeS3(data, multipart=False, failures={"bytes=100-199": 1})
+    fout = io.BytesIO()
+
+    failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', fout, threads=3, range_size=100)
+    assert failed == 0
+    assert fout.getvalue() == data
+    assert len(set(s3.calls)) == 8
+
+
+def test_fetch_ranges_resumable(tmpdir):
+    data = bytes(range(256)) * 3
+    path = str(tmpdir.join('output'))
+    s3 = FakeS3(data, failures={"bytes=0-99": 1})
+
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, retries=1, range_size=100)
+    assert failed == 1
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path, threads=4, range_size=100)
+    assert failed == 0
+    assert tmpdir.join('output').read_binary() == data
+
+
+def test_etag_mismatch():
+    s3 = FakeS3(b"z" * 95)
+    s3.etag = lambda: '"0123-10"'
+
+    failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', io.BytesIO())
+    assert failed == 1
+
+
+def test_fetch_empty_object(tmpdir):
+    s3 = FakeS3(b"", multipart=False)
+    fout = io.BytesIO()
+
+    failed, _ = s3_fetcher.fetch(s3, 'bucket', 'key', fout)
+    assert failed == 0
+    assert fout.getvalue() == b""
+    assert s3.calls == []
+
+    path = str(tmpdir.join('output'))
+    failed, _ = s3_fetcher.fetch_resumable(s3, 'bucket', 'key', path)
+    assert failed == 0
+    assert tmpdir.join('output').read_binary() == b""
+
+
+def test_verifiable_etag():
+    assert s3_fetcher.verifiable_etag({'ETag': '"abc"'}) == '"abc"'
+    assert s3_fetcher.verifiable_etag({'ETag': '"abc"', 'ServerSideEncryption': 'aws:kms'}) is None
+    assert s3_fetcher.verifiable_etag({'ETag': '"abc"', 'SSECustomerAlgorithm': 'AES256'}) is None
+
+
+def test_multipart_etag_verified():
+    data = b"z" * 95
+    parts = s3_fetcher.Parts(FakeS3(data), 'bucket', 'key', 10, io.BytesIO(), part_size=PART_SIZE,
+                             etag=FakeS3(data).etag())
+    assert parts.download() == 0
+    assert parts.verify() is True
+
+
+def test_stream_writer_decompresses():
+    data = b"a,b\n1,2\n" * 100
+    members = gzip.compress(data[:400]) + gzip.compress(data[400:])
+    out = io.BytesIO()
+    writer = s3_fetcher.StreamWriter(out, 'gzip')
+    for i in range(0, len(members), 7):
+        writer.write(members[i:i + 7])
+    assert out.getvalue() == data
+    assert writer.bytes_in == len(members)
+
+    out = io.BytesIO()
+    s3_fetcher.StreamWriter(out, 'bz2').write(bz2.compress(data))
+    assert out.getvalue() == data
+
+
+def test_detect_compression():
+    assert s3_fetcher.detect_compression('exports/2018/data.csv.gz') == 'gzip'
+    assert s3_fetcher.detect_compression('exports/2018/data.csv.bz2') == 'bz2'
+    assert s3_fetcher.detect_compression('exports/2018/data.csv') is None
+    assert s3_fetcher.detect_compression('data.gz', 'none') is None
+
+
+def test_run_streams_into_copy(tmpdir, monkeypatch):
+    data = b"a,b\n" + b"1,2\n" * 50
+    s3 = FakeS3(gzip.compress(data), multipart=False)
+    session = mock.Mock()
+    session.return_value.client.return_value = s3
+    monkeypatch.setattr(s3_fetcher.boto3, 'Session', session)
+
+    copied = []
+
+    def execute(statement):
+        # Read the named pipe like COPY ... FROM LOCAL would
+        if statement.startswith("COPY"):
+            with open(statement.split("'")[1], 'rb') as f:
+                copied.append(f.read())
+
+    cnxn = mock.Mock()
+    cnxn.cursor.return_value.execute.side_effect = execute
+    pool = ConnectionPool("vertica", connector=lambda dsn: cnxn)
+    config = {'data_dir': str(tmpdir), 'vertica': {'dsn': 'vertica'}}
+
+    summary = s3_fetcher.run(config, pool, 'foo', 'bucket', 'exports/data.csv.gz')
+    assert copied == [data]
+    assert summary['bytes'] == len(s3.data)
+    assert cnxn.commit.call_count == 1
+    assert not tmpdir.join('s3', 'foo', 'stream').check()
+
+
+def test_run_does_not_commit_partial_streams(tmpdir, monkeypatch):
+    s3 = FakeS3(b"1,2\n" * 50, failures={3: 10})
+    session = mock.Mock()
+    session.return_value.client.return_value = s3
+    monkeypatch.setattr(s3_fetcher.boto3, 'Session', session)
+
+    statements = []
+
+    def execute(statement):
+        statements.append(statement)
+        if statement.startswith("COPY"):
+            open(statement.split("'")[1], 'rb').read()
+
+    cnxn = mock.Mock()
+    cnxn.cursor.return_value.execute.side_effect = execute
+    pool = ConnectionPool("vertica", connector=lambda dsn: cnxn)
+    config = {'data_dir': str(tmpdir), 'vertica': {'dsn': 'vertica'}}
+
+    with pytest.raises(s3_fetcher.ReadException):
+        s3_fetcher.run(config, pool, 'foo', 'bucket', 'data.csv', header=False)
+    assert cnxn.commit.call_count == 0
+    assert cnxn.rollback.call_count == 1
+    # TRUNCATE would commit on its own and leave the table empty, the rows are deleted in the rolled back transaction
+    assert not any(statement.startswith("TRUNCATE") for statement in statements)
+    assert statements[0] == "DELETE FROM foo"
+
+
+def test_run_unblocks_writer_when_load_fails(tmpdir, monkeypatch):
+    s3 = FakeS3(b"1,2\n" * 5000)
+    session = mock.Mock()
+    session.return_value.client.return_value = s3
+    monkeypatch.setattr(s3_fetcher.boto3, 'Session', session)
+
+    cnxn = mock.Mock()
+    cnxn.cursor.return_value.execute.side_effect = RuntimeError("permission denied")
+    pool = ConnectionPool("vertica", connector=lambda dsn: cnxn)
+    config = {'data_dir': str(tmpdir), 'vertica': {'dsn': 'vertica'}}
+
+    with pytest.raises(RuntimeError):
+        s3_fetcher.run(config, pool, 'foo', 'bucket', 'data.csv')
+    assert not tmpdir.join('s3', 'foo', 'stream').check()
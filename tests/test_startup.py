@@ -0,0 +1,36 @@
+import subprocess
+import sys
+import time
+
+# Modules that are slow to import and only needed once a subcommand runs
+HEAVY_MODULES = ['pandas', 'pyodbc', 'requests', 'boto3', 'pkg_resources']
+
+SCRIPT = """
+import sys
+import collectors
+try:
+    collectors.cli(['--help'], obj={})
+except SystemExit:
+    pass
+print('imported:' + ','.join(m for m in %r if m in sys.modules))
+"""
+
+
+def test_startup_imports():
+    """
+    `data-collectors --help` must not pay for the dependencies of the subcommands
+    """
+    started = time.time()
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT % HEAVY_MODULES], universal_newlines=True)
+    elapsed = time.time() - started
+
+    assert 'Commands:' in output
+    assert output.strip().splitlines()[-1] == 'imported:'
+    print("Started in {:.0f}ms".format(elapsed * 1000))
+
+
+def test_lazy_subcommand():
+    from collectors.main import cli
+
+    assert cli.get_command(None, 'run-batch').name == 'run-batch'
+    assert cli.get_command(None, 'nope') is None